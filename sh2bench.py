@@ -0,0 +1,752 @@
+import os
+import sys
+import time
+import json
+import zlib
+import struct
+import random
+import shutil
+import argparse
+import tempfile
+
+import sh2ex
+
+#
+# Synthetic disc images for measuring sh2ex without a retail disc, and a
+# benchmark harness on top of them.
+#
+# The images hold everything the extractor walks: an ISO9660 filesystem (in
+# any of the three layouts ISOFS_IMAGE detects), an executable whose CRC-32
+# matches a supported version and whose TOC points into a set of archives
+# (including nested packs and entries without an archive), and a SOUND.DAT
+# with the IRX tables describing its banks and streams.
+#
+
+# ----------------------------------------------------------------------------
+# CRC-32 forging
+# ----------------------------------------------------------------------------
+
+crc_table = []
+for i in range(256):
+    c = i
+    for k in range(8):
+        c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+    crc_table.append(c)
+
+# the top byte of every table entry is unique
+crc_rtable = dict((t >> 24, i) for i, t in enumerate(crc_table))
+
+def forge_crc32(data, target):
+    #
+    # 4 bytes that, appended to `data`, make its CRC-32 equal `target`
+    #
+    state = zlib.crc32(data) ^ 0xFFFFFFFF
+    s = target ^ 0xFFFFFFFF
+    for k in range(4):
+        i = crc_rtable[s >> 24]
+        s = (((s ^ crc_table[i]) << 8) & 0xFFFFFFFF) | i
+    return struct.pack("<I", s ^ state)
+
+# ----------------------------------------------------------------------------
+# Sectors
+# ----------------------------------------------------------------------------
+
+LAYOUTS = ("user", "mode1", "xa")
+
+def bcd(n):
+    return ((n // 10) << 4) | (n % 10)
+
+def msf(lba):
+    lba += 150
+    return bytes((bcd(lba // 4500), bcd((lba // 75) % 60), bcd(lba % 75)))
+
+def raw_sector(layout, lba, data, form2, ecc):
+    sector = bytearray(2352)
+    sector[0x00:0x0C] = sh2ex.SYNC
+    sector[0x0C:0x0F] = msf(lba)
+    if layout == "mode1":
+        sector[0x0F] = 1
+        sector[0x10:0x810] = data
+        if ecc:
+            sector[0x810:0x814] = struct.pack("<I", sh2ex.edc_compute(sector[0x00:0x810]))
+            sh2ex.ecc_generate(sector, 0)
+    else:
+        sector[0x0F] = 2
+        submode = 0x20 if form2 else 0x08
+        sector[0x10:0x18] = bytes((0, 0, submode, 0)) * 2
+        if form2:
+            sector[0x18:0x92C] = data
+            if ecc:
+                sector[0x92C:0x930] = struct.pack("<I", sh2ex.edc_compute(sector[0x10:0x92C]))
+        else:
+            sector[0x18:0x818] = data
+            if ecc:
+                sector[0x818:0x81C] = struct.pack("<I", sh2ex.edc_compute(sector[0x10:0x818]))
+                sh2ex.ecc_generate(sector, 1)
+    return sector
+
+# ----------------------------------------------------------------------------
+# ISO9660
+# ----------------------------------------------------------------------------
+
+def both16(n):
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+def both32(n):
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+def dir_record(name, lba, size, is_dir):
+    ident = name if isinstance(name, bytes) else (name + ("" if is_dir else ";1")).encode("ASCII")
+    length = 33 + len(ident)
+    length += length & 1
+    rec = bytearray(length)
+    rec[0] = length
+    rec[2:10] = both32(lba)
+    rec[10:18] = both32(size)
+    rec[18:25] = bytes((101, 1, 1, 0, 0, 0, 0))
+    rec[25] = 2 if is_dir else 0
+    rec[28:32] = both16(1)
+    rec[32] = len(ident)
+    rec[33:33+len(ident)] = ident
+    return bytes(rec)
+
+def pack_dir(records):
+    # records may not cross a sector boundary
+    out = bytearray()
+    for rec in records:
+        if len(out) // 2048 != (len(out) + len(rec) - 1) // 2048:
+            out += b"\x00" * (2048 - len(out) % 2048)
+        out += rec
+    if len(out) % 2048:
+        out += b"\x00" * (2048 - len(out) % 2048)
+    return out
+
+class ISO_BUILDER:
+    def __init__(self, layout="user", ecc=False):
+        self.layout = layout
+        self.ecc = ecc
+        self.files = []
+
+    def add(self, path, data, form2=False):
+        self.files.append((path.upper(), data, form2 and self.layout == "xa"))
+
+    def user_size(self, form2):
+        return 2324 if form2 else 2048
+
+    def build(self, outpath):
+        dirs = {"": []}
+        for path, data, form2 in self.files:
+            parts = path.split("/")
+            for k in range(1, len(parts)):
+                parent = "/".join(parts[:k-1])
+                d = "/".join(parts[:k])
+                if d not in dirs:
+                    dirs[d] = []
+                    dirs[parent].append((parts[k-1], d, True))
+            dirs["/".join(parts[:-1])].append((parts[-1], path, False))
+
+        # directory sizes first (names are fixed, LBAs don't change sizes)
+        dir_sizes = {}
+        for d, entries in dirs.items():
+            records = [dir_record(b"\x00", 0, 0, True), dir_record(b"\x01", 0, 0, True)]
+            for name, full, is_dir in entries:
+                records.append(dir_record(name, 0, 0, is_dir))
+            dir_sizes[d] = len(pack_dir(records))
+
+        lba = 18
+        dir_lba = {}
+        for d in sorted(dirs):
+            dir_lba[d] = lba
+            lba += dir_sizes[d] // 2048
+
+        file_lba = {}
+        file_size = {}
+        for path, data, form2 in self.files:
+            file_lba[path] = lba
+            file_size[path] = len(data)
+            usz = self.user_size(form2)
+            lba += max(1, (len(data) + usz - 1) // usz)
+        total = lba
+
+        sectors = [(b"", False)] * 16
+
+        pvd = bytearray(2048)
+        pvd[0:7] = b"\x01CD001\x01"
+        pvd[8:40] = b"PLAYSTATION".ljust(32)
+        pvd[40:72] = b"SH2EX_SYNTHETIC".ljust(32)
+        pvd[80:88] = both32(total)
+        pvd[120:124] = both16(1)
+        pvd[124:128] = both16(1)
+        pvd[128:132] = both16(2048)
+        pvd[156:190] = dir_record(b"\x00", dir_lba[""], dir_sizes[""], True)
+        pvd[881] = 1
+        sectors.append((bytes(pvd), False))
+
+        term = bytearray(2048)
+        term[0:7] = b"\xFFCD001\x01"
+        sectors.append((bytes(term), False))
+
+        for d in sorted(dirs):
+            parent = d.rsplit("/", 1)[0] if "/" in d else ""
+            records = [dir_record(b"\x00", dir_lba[d], dir_sizes[d], True),
+                       dir_record(b"\x01", dir_lba[parent], dir_sizes[parent], True)]
+            for name, full, is_dir in sorted(dirs[d]):
+                if is_dir:
+                    records.append(dir_record(name, dir_lba[full], dir_sizes[full], True))
+                else:
+                    records.append(dir_record(name, file_lba[full], file_size[full], False))
+            buf = pack_dir(records)
+            for k in range(0, len(buf), 2048):
+                sectors.append((buf[k:k+2048], False))
+
+        with open(outpath, "wb") as out:
+            lba = 0
+            for data, form2 in sectors:
+                self.write_sector(out, lba, data, form2)
+                lba += 1
+            for path, data, form2 in self.files:
+                usz = self.user_size(form2)
+                count = max(1, (len(data) + usz - 1) // usz)
+                for k in range(count):
+                    self.write_sector(out, lba, data[k*usz:(k+1)*usz], form2)
+                    lba += 1
+
+        return dict((path, (file_lba[path], file_size[path])) for path in file_lba)
+
+    def write_sector(self, out, lba, data, form2):
+        usz = self.user_size(form2)
+        if len(data) < usz:
+            data = bytes(data) + b"\x00" * (usz - len(data))
+        if self.layout == "user":
+            out.write(data)
+        else:
+            out.write(raw_sector(self.layout, lba, data, form2, self.ecc))
+
+# ----------------------------------------------------------------------------
+# Game content
+# ----------------------------------------------------------------------------
+
+VFS_DIRS = ["data/bg", "data/chr", "data/item", "data/menu", "data/pic"]
+
+def adpcm_encode(samples):
+    # filter 0 only: good enough to produce valid, decodable frames
+    out = bytearray()
+    for k in range(0, len(samples), 28):
+        block = samples[k:k+28]
+        block = block + [0] * (28 - len(block))
+        peak = max(abs(s) for s in block)
+        shift = 12
+        while shift > 0 and peak > (7 << (12 - shift)):
+            shift -= 1
+        frame = bytearray(16)
+        frame[0] = shift
+        for n in range(28):
+            v = int(round(block[n] / float(1 << (12 - shift))))
+            v = max(-8, min(7, v)) & 0x0F
+            if n & 1:
+                frame[2 + n // 2] |= v << 4
+            else:
+                frame[2 + n // 2] |= v
+        out += frame
+    if out:
+        out[-15] = 0x01
+    return out
+
+def tone(length, period, amp):
+    return [int(amp * ((n % period) * 2.0 / period - 1.0)) for n in range(length)]
+
+def build_bank(rng, scale):
+    #
+    # HD (Vers/Head/Vagi chunks) + BD (ADPCM samples) of a sound bank
+    #
+    nsamples = rng.randint(1, 4)
+    bd = bytearray()
+    offsets = []
+    rates = []
+    for k in range(nsamples):
+        offsets.append(len(bd))
+        rates.append(rng.choice((11025, 22050, 44100)))
+        bd += adpcm_encode(tone(28 * rng.randint(4, int(40 * scale) + 4), rng.randint(20, 200), 8000))
+    vagi_off = 0x40
+    vagi = bytearray(b"IECSigaV")
+    vagi += struct.pack("<II", 0x10 + 4 * nsamples + 8 * nsamples, nsamples - 1)
+    info_off = 0x10 + 4 * nsamples
+    for k in range(nsamples):
+        vagi += struct.pack("<I", info_off + 8 * k)
+    for k in range(nsamples):
+        vagi += struct.pack("<IHBB", offsets[k], rates[k], 0, 0xFF)
+    hd = bytearray(vagi_off)
+    hd[0x00:0x10] = b"IECSsreV" + struct.pack("<II", 0x10, 0)
+    hd[0x10:0x18] = b"IECSdaeH"
+    hd += vagi
+    struct.pack_into("<IIIIIIII", hd, 0x18, 0x30, len(hd), len(bd), 0, 0, 0, vagi_off, 0)
+    return bytes(hd), bytes(bd)
+
+def build_svag(rng, scale):
+    #
+    # Interleaved ADPCM stream; encoding whole streams would take ages, so a
+    # short encoded loop is tiled instead
+    #
+    channels = rng.choice((1, 2))
+    interleave = 0x800
+    frames = rng.randint(8, int(200 * scale) + 8) * (interleave // 16)
+    data = bytearray()
+    chans = []
+    for c in range(channels):
+        loop = adpcm_encode(tone(28 * 64, 28 * rng.choice((2, 4, 8)), 6000))
+        loop[-15] = 0
+        chan = loop * (frames // 64 + 1)
+        chan = chan[:frames * 16]
+        chan[-15] = 0x01
+        chans.append(chan)
+    for k in range(0, frames * 16, interleave):
+        for c in range(channels):
+            data += chans[c][k:k+interleave]
+    header = bytearray(0x800)
+    header[0:4] = b"Svag"
+    struct.pack_into("<IIHHIII", header, 4, len(data), 44100, channels, 0, interleave, 0, 0)
+    return bytes(header + data)
+
+def build_game(outpath, layout="user", meta_index=1, scale=1.0, seed=1, ecc=False, filler=64, archives=6):
+    #
+    # Writes a synthetic image of the version metalist[meta_index] to
+    # `outpath`. `scale` sizes the files (1.0 is roughly 100 MB of them).
+    # Returns the expected contents of the "vfs" and "sound" output trees.
+    #
+    rng = random.Random(seed)
+    meta = sh2ex.metalist[meta_index]
+
+    #
+    # VFS archives + executable
+    #
+    toc_offset = meta["toc_offset"]
+    toc_count = meta["toc_count"]
+    seg_off = 0x1000
+    seg_vaddr = 0x00100000
+
+    heap = bytearray()
+    heap_base = toc_offset + toc_count * 8
+
+    def addr(off):
+        return off - seg_off + seg_vaddr
+
+    def alloc(data):
+        off = heap_base + len(heap)
+        heap.extend(data)
+        while len(heap) % 4:
+            heap.append(0)
+        return addr(off)
+
+    arc_names = ["data/arc%02d.bin" % k for k in range(archives)]
+    arc_data = [bytearray() for k in range(archives)]
+    arc_nodes = []
+    for name in arc_names:
+        path_addr = alloc(name.encode("ASCII") + b"\x00")
+        arc_nodes.append(alloc(struct.pack("<II", 0x01, path_addr)))
+    ghost_path = alloc(b"data/missing.bin\x00")
+    ghost_node = alloc(struct.pack("<II", 0x01, ghost_path))
+
+    toc = []
+    packs = {}
+    expected = {}
+    for i in range(toc_count):
+        r = rng.random()
+        if r < 0.05:
+            # not a file
+            toc.append((arc_nodes[rng.randrange(archives)], alloc(b"\x00")))
+            continue
+        k = rng.randrange(archives)
+        size = rng.randint(1, int(24000 * scale) + 1)
+        vfs_path = "%s/%05d.bin" % (rng.choice(VFS_DIRS), i)
+        data = rng.randbytes(size)
+        if r < 0.08:
+            # in an archive that isn't on the disc
+            node = alloc(struct.pack("<IIII", 0x50, ghost_node, 0, size))
+        elif r < 0.35:
+            # nested pack inside archive k
+            if k not in packs or len(packs[k][1]) > 40:
+                base = len(arc_data[k])
+                pack_node = alloc(struct.pack("<IIII", 0x50, arc_nodes[k], base, 0))
+                packs[k] = (pack_node, bytearray(), base)
+            pack_node, pack_buf, base = packs[k]
+            node = alloc(struct.pack("<IIII", 0x50, pack_node, len(pack_buf), size))
+            pack_buf += data
+            expected[vfs_path] = data
+            need = base + len(pack_buf)
+            if len(arc_data[k]) < need:
+                arc_data[k] += b"\x00" * (need - len(arc_data[k]))
+            arc_data[k][base:need] = pack_buf
+        else:
+            if k in packs:
+                del packs[k]
+            node = alloc(struct.pack("<IIII", 0x50, arc_nodes[k], len(arc_data[k]), size))
+            arc_data[k] += data
+            expected[vfs_path] = data
+        toc.append((node, alloc(vfs_path.encode("ASCII") + b"\x00")))
+
+    exe = bytearray(heap_base + len(heap))
+    exe[0:4] = b"\x7fELF"
+    exe[4:7] = b"\x01\x01\x01"
+    struct.pack_into("<HHIIIIIHHHHHH", exe, 0x10, 2, 8, 1, seg_vaddr, 0x34, 0, 0, 0x34, 0x20, 1, 0x28, 0, 0)
+    struct.pack_into("<IIIIIIII", exe, 0x34, 1, seg_off, seg_vaddr, seg_vaddr, len(exe) - seg_off, len(exe) - seg_off, 7, 0x10)
+    for off in range(0x1000, toc_offset, 0x1000):
+        exe[off:off+16] = rng.randbytes(16)
+    for n, (node, path) in enumerate(toc):
+        struct.pack_into("<II", exe, toc_offset + n * 8, node, path)
+    exe[heap_base:] = heap
+    exe += forge_crc32(exe, meta["execrc"])
+
+    #
+    # IRX + SOUND.DAT
+    #
+    seq_count = meta["seq_ent_count"]
+    stm_count = meta["stm_ent_count"]
+    irx = bytearray(max(meta["seq_tbl_offset"] + seq_count * 20, meta["stm_tbl_offset"] + stm_count * 12) + 0x100)
+    irx[0:4] = b"\x7fELF"
+
+    dat = bytearray()
+    sound = {}
+    core = misc = 0
+    for i in range(seq_count):
+        if i < 2:
+            sid, base = 0, "TD %02d - Core SFX %02d" % (i, core)
+            core += 1
+        elif i < 4:
+            sid, base = 1, "TD %02d - Misc SFX %02d" % (i, misc)
+            misc += 1
+        else:
+            sid = 50000 + i * 10
+            base = "TD %02d - BGM %d" % (i, sid)
+        hd, bd = build_bank(rng, scale)
+        td = rng.randbytes(rng.randint(16, int(4000 * scale) + 16))
+        bank_sect = len(dat) // 2048
+        dat += hd + bd
+        dat += b"\x00" * (-len(dat) % 2048)
+        td_sect = len(dat) // 2048
+        dat += td
+        dat += b"\x00" * (-len(dat) % 2048)
+        struct.pack_into("<IIIII", irx, meta["seq_tbl_offset"] + i * 20, sid, bank_sect, len(hd) + len(bd), td_sect, len(td))
+        sound["TriggerData/%s.HD" % base] = hd
+        sound["TriggerData/%s.BD" % base] = bd
+        sound["TriggerData/%s.TD" % base] = td
+
+    if len(dat) > meta["stm_start_sect"] * 2048:
+        raise ValueError("Sequence data overflows into the stream area, use a smaller scale")
+    dat += b"\x00" * (meta["stm_start_sect"] * 2048 - len(dat))
+
+    for i in range(stm_count):
+        stm = build_svag(rng, scale)
+        struct.pack_into("<III", irx, meta["stm_tbl_offset"] + i * 12, len(dat) // 2048, len(stm), 0x7F)
+        dat += stm
+        dat += b"\x00" * (-len(dat) % 2048)
+        sound["Streams/Stream %03d.svag" % i] = stm
+
+    irx += forge_crc32(irx, meta["irxcrc"])
+
+    #
+    # Disc; a Form 2 movie makes XA images mixed-form, and the filler files
+    # make a directory span several sectors
+    #
+    builder = ISO_BUILDER(layout, ecc)
+    builder.add("SYSTEM.CNF", b"BOOT2 = cdrom0:\\%s;1\r\nVER = 1.00\r\n" % meta["exepath"].encode("ASCII"))
+    builder.add(meta["exepath"], bytes(exe))
+    builder.add(meta["irxpath"], bytes(irx))
+    for k in range(archives):
+        builder.add(arc_names[k].upper(), bytes(arc_data[k]))
+    builder.add(meta["datpath"], bytes(dat))
+    builder.add("MOVIE/OPENING.STR", rng.randbytes(2324 * 40 + 1000), form2=True)
+    for k in range(filler):
+        builder.add("DUMMY/FILLER_FILE_%04d.DAT" % k, rng.randbytes(rng.randint(1, 3000)))
+    builder.build(outpath)
+
+    return {"vfs": expected, "sound": sound}
+
+def verify_output(out_dir, expected):
+    #
+    # Number of files under out_dir/<root> that are missing or differ
+    #
+    bad = 0
+    for root in expected:
+        for path, data in expected[root].items():
+            try:
+                with open(os.path.join(out_dir, root, path), "rb") as f:
+                    if f.read() != data:
+                        bad += 1
+            except OSError:
+                bad += 1
+    return bad
+
+# ----------------------------------------------------------------------------
+# Benchmarks
+# ----------------------------------------------------------------------------
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def latency(values):
+    return {
+        "p50_ms" : percentile(values, 0.50) * 1000,
+        "p95_ms" : percentile(values, 0.95) * 1000,
+    }
+
+def better(result, best):
+    if result["mb_s"] is not None:
+        return result["mb_s"] > best["mb_s"]
+    return result["p50_ms"] < best["p50_ms"]
+
+def all_entries(plan):
+    return [entry for root in plan for entry in plan[root]]
+
+def bench_read_user(disk, plan, rng, count):
+    #
+    # Sequential read_user() of the largest file in CHUNK_SIZE pieces, then
+    # random single-sector reads for latency
+    #
+    entries = all_entries(plan)
+    entry = max(entries, key=lambda entry: entry["size"])
+
+    disk.seek_user(entry["lba"], entry["offset"])
+    start = time.perf_counter()
+    done = 0
+    while done < entry["size"]:
+        got = len(disk.read_user(min(sh2ex.CHUNK_SIZE, entry["size"] - done)))
+        if got <= 0:
+            break
+        done += got
+    elapsed = time.perf_counter() - start
+
+    times = []
+    for k in range(count):
+        entry = rng.choice(entries)
+        disk.seek_user(entry["lba"], entry["offset"] + rng.randrange(entry["size"]))
+        start = time.perf_counter()
+        disk.read_user(2048)
+        times.append(time.perf_counter() - start)
+
+    result = {"mb_s": done / elapsed / 1e6, "files": 1}
+    result.update(latency(times))
+    return result
+
+def bench_seek_user(disk, plan, rng, count):
+    #
+    # seek_user() to random offsets into random files; costs the most for
+    # XA images, where positions depend on the Form of every sector
+    #
+    entries = all_entries(plan)
+
+    times = []
+    for k in range(count):
+        entry = rng.choice(entries)
+        offset = entry["offset"] + rng.randrange(entry["size"])
+        start = time.perf_counter()
+        disk.seek_user(entry["lba"], offset)
+        times.append(time.perf_counter() - start)
+
+    result = {"mb_s": None, "files": count}
+    result.update(latency(times))
+    return result
+
+def bench_extract(disk, plan, tmp_dir):
+    #
+    # extract() of every file of the plan, one at a time
+    #
+    out_path = os.path.join(tmp_dir, "extract.bin")
+
+    times = []
+    size = 0
+    for entry in all_entries(plan):
+        start = time.perf_counter()
+        disk.seek_user(entry["lba"], entry["offset"])
+        disk.extract(out_path, entry["size"])
+        times.append(time.perf_counter() - start)
+        size += entry["size"]
+
+    os.unlink(out_path)
+
+    result = {"mb_s": size / sum(times) / 1e6, "files": len(times)}
+    result.update(latency(times))
+    return result
+
+def bench_end_to_end(image, expected, tmp_dir, use_mmap, jobs):
+    #
+    # Everything a run does: open, detect, plan, extract. Files are extracted
+    # in parallel, so there is no latency per file, only the mean time a run
+    # takes per file.
+    #
+    out_dir = os.path.join(tmp_dir, "out")
+
+    start = time.perf_counter()
+    disk = sh2ex.ISOFS_IMAGE(image, use_mmap=use_mmap)
+    meta, plan = sh2ex.make_plan(disk, use_cache=False)
+    for root in plan:
+        sh2ex.extract_entries(disk, os.path.join(out_dir, root), plan[root], jobs, verbose=0)
+    elapsed = time.perf_counter() - start
+    disk.close()
+
+    bad = verify_output(out_dir, expected)
+    shutil.rmtree(out_dir)
+    if bad:
+        raise ValueError("%d files extracted from %s are wrong" % (bad, image))
+
+    entries = all_entries(plan)
+
+    return {
+        "mb_s"   : sum(entry["size"] for entry in entries) / elapsed / 1e6,
+        "files"  : len(entries),
+        "p50_ms" : None,
+        "p95_ms" : None,
+        "mean_ms": elapsed / len(entries) * 1000,
+    }
+
+def run(args):
+    work_dir = args.dir or tempfile.mkdtemp(prefix="sh2bench-")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    rng = random.Random(args.seed)
+    results = []
+
+    try:
+        for layout in args.layouts:
+            image = os.path.join(work_dir, "bench-%s.%s" % (layout, "iso" if layout == "user" else "bin"))
+
+            print("Generating %s image (scale %g) ..." % (layout, args.scale))
+            expected = build_game(image, layout, args.version, args.scale, args.seed, args.ecc)
+
+            disk = sh2ex.ISOFS_IMAGE(image, use_mmap=not args.no_mmap)
+            meta, plan = sh2ex.make_plan(disk, use_cache=False)
+            if plan is None:
+                raise ValueError("%s was not recognized" % image)
+
+            benchmarks = [
+                ("read_user",  lambda: bench_read_user(disk, plan, rng, args.count)),
+                ("seek_user",  lambda: bench_seek_user(disk, plan, rng, args.count)),
+                ("extract",    lambda: bench_extract(disk, plan, work_dir)),
+                ("end_to_end", lambda: bench_end_to_end(image, expected, work_dir, not args.no_mmap, args.jobs)),
+            ]
+
+            for name, bench in benchmarks:
+                # best of N, the rest is noise
+                best = None
+                for k in range(args.repeat):
+                    result = bench()
+                    if best is None or better(result, best):
+                        best = result
+                best["layout"] = layout
+                best["bench"] = name
+                results.append(best)
+                print_result(best)
+
+            disk.close()
+            os.unlink(image)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            return compare(json.load(f), results, args.tolerance)
+
+    return 0
+
+def print_result(result):
+    def fmt(value, spec):
+        return "-" if value is None else spec % value
+    print("  %-6s %-10s %10s MB/s %6d files  p50 %9s ms  p95 %9s ms  mean %9s ms" % (
+        result["layout"], result["bench"], fmt(result["mb_s"], "%.1f"), result["files"],
+        fmt(result["p50_ms"], "%.3f"), fmt(result["p95_ms"], "%.3f"), fmt(result.get("mean_ms"), "%.3f")))
+
+def compare(baseline, results, tolerance):
+    #
+    # Flags every benchmark that got slower than the baseline by more than
+    # `tolerance` (a fraction), in throughput, in median latency or, where
+    # there is no latency per file, in mean time per file. Returns 1 if any
+    # did.
+    #
+    base = dict(((result["layout"], result["bench"]), result) for result in baseline)
+
+    regressed = 0
+
+    for result in results:
+        old = base.get((result["layout"], result["bench"]))
+        if old is None:
+            continue
+        if old["mb_s"] and result["mb_s"] is not None and result["mb_s"] < old["mb_s"] * (1 - tolerance):
+            print("REGRESSION: %s %s: %.1f MB/s, was %.1f MB/s" % (result["layout"], result["bench"], result["mb_s"], old["mb_s"]))
+            regressed = 1
+        if old["p50_ms"] and result["p50_ms"] is not None and result["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            print("REGRESSION: %s %s: p50 %.3f ms, was %.3f ms" % (result["layout"], result["bench"], result["p50_ms"], old["p50_ms"]))
+            regressed = 1
+        if old.get("mean_ms") and result.get("mean_ms") is not None and result["mean_ms"] > old["mean_ms"] * (1 + tolerance):
+            print("REGRESSION: %s %s: mean %.3f ms, was %.3f ms" % (result["layout"], result["bench"], result["mean_ms"], old["mean_ms"]))
+            regressed = 1
+
+    if not regressed:
+        print("No regressions against %d baseline results." % len(baseline))
+
+    return regressed
+
+def main(argc=len(sys.argv), argv=sys.argv):
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+        description="Synthetic disc images and benchmarks for sh2ex")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    gen = commands.add_parser("generate",
+        help="write a synthetic disc image")
+    gen.add_argument("image",
+        help="path of the image to write")
+
+    bench = commands.add_parser("run",
+        help="generate images and benchmark sh2ex on them")
+    bench.add_argument("--layouts", type=lambda s: s.split(","), default=list(LAYOUTS), metavar="LIST",
+        help="comma-separated layouts to benchmark (default: user,mode1,xa)")
+    bench.add_argument("--dir", metavar="DIR",
+        help="where to put the images (default: a temporary directory)")
+    bench.add_argument("--repeat", type=int, default=3, metavar="N",
+        help="run every benchmark N times and keep the best (default: 3)")
+    bench.add_argument("--count", type=int, default=2000, metavar="N",
+        help="random reads / seeks per latency benchmark (default: 2000)")
+    bench.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+        help="extraction jobs of the end-to-end benchmark (default: 1)")
+    bench.add_argument("--no-mmap", action="store_true",
+        help="read the images with pread instead of mapping them")
+    bench.add_argument("--json", metavar="FILE",
+        help="also write the results to FILE")
+    bench.add_argument("--compare", metavar="FILE",
+        help="compare against the results in FILE (from --json), exit with 1 on regressions")
+    bench.add_argument("--tolerance", type=float, default=0.25, metavar="FRACTION",
+        help="slowdown tolerated by --compare (default: 0.25)")
+
+    for sub in (gen, bench):
+        if sub is gen:
+            sub.add_argument("--layout", choices=LAYOUTS, default="user",
+                help="user (2048-byte sectors), mode1 (raw Mode 1) or xa (raw Mode 2 XA, mixed Forms)")
+        sub.add_argument("--scale", type=float, default=0.2,
+            help="size of the files, 1.0 being about 100 MB of them (default: 0.2)")
+        sub.add_argument("--version", type=int, default=1, metavar="N",
+            help="index of the emulated version in sh2ex.metalist (default: 1)")
+        sub.add_argument("--seed", type=int, default=1,
+            help="random seed (default: 1)")
+        sub.add_argument("--ecc", action="store_true",
+            help="compute real EDC/ECC for raw sectors (slow)")
+
+    args = parser.parse_args(argv[1:argc])
+
+    if args.command == "generate":
+        expected = build_game(args.image, args.layout, args.version, args.scale, args.seed, args.ecc)
+        print("Wrote %s: %s, %d VFS and %d sound files" % (args.image, sh2ex.metalist[args.version]["name"], len(expected["vfs"]), len(expected["sound"])))
+        return 0
+
+    return run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,69 @@
 import os
+import io
 import sys
+import time
+import mmap
 import struct
 import zlib
+import wave
+import array
+import hashlib
+import bisect
+import json
+import fnmatch
+import contextlib
+import re
+import sqlite3
+import shutil
+import tarfile
+import zipfile
+import argparse
+import collections
+import tempfile
+import threading
+import queue
+import concurrent.futures
+import http.server
+import urllib.parse
+import mimetypes
+import xml.sax.saxutils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# size of the buffers used when copying file data out of an image
+CHUNK_SIZE = 0x100000
+
+# buffers in flight between the reader and the writer of a copy (1 to copy
+# synchronously), and their size
+IO_DEPTH = 4
+IO_BUFFER = CHUNK_SIZE
+
+# entries up to this size are hashed in memory before going into a store,
+# larger ones are read a second time if they turn out to be new
+STORE_INLINE_SIZE = 8 << 20
+
+# METRICS of the current run, if instrumented
+metrics = None
 
 metalist = [
     # SLUS-20228 (VW047-U1 prototype) (v0.10)
     # Executable timestamp: 2001-07-13 12:55:24 GMT+0900
     {
+        "name"           : "SLUS-20228 (VW047-U1 prototype) (v0.10)",
+
         "exepath"        : "SLUS_202.28",
         "execrc"         : 0xFCD793AC,
         "toc_offset"     : 0x29CD00,
@@ -26,6 +83,8 @@ metalist = [
     # SLPM-12345 - E3 Demo (v0.30)
     # Executable timestamp: 2001-05-01 10:13:56 GMT+0900
     {
+        "name"           : "SLPM-12345 - E3 Demo (v0.30)",
+
         "exepath"        : "SLPM_123.45",
         "execrc"         : 0x8556FA90,
         "toc_offset"     : 0x45C200,
@@ -45,6 +104,8 @@ metalist = [
     # SLPM-61009 - Trial Version (v1.20)
     # Executable timestamp: 2001-08-11 11:18:02 GMT+0900
     {
+        "name"           : "SLPM-61009 - Trial Version (v1.20)",
+
         "exepath"        : "SLPM_610.09",
         "execrc"         : 0x37E6204D,
         "toc_offset"     : 0x2B3180,
@@ -64,6 +125,8 @@ metalist = [
     # SLPM-65051 (v1.50)
     # Executable timestamp: 2001-08-22 02:50:16 GMT+0900
     {
+        "name"           : "SLPM-65051 (v1.50)",
+
         "exepath"        : "SLPM_650.51",
         "execrc"         : 0x2FB23919,
         "toc_offset"     : 0x2BB900,
@@ -85,6 +148,8 @@ metalist = [
     # SLPM-65631 - Saigo no Uta - Konami Dendou Selection (v1.50)
     # Executable timestamp: 2002-02-26 06:11:56 GMT+0900
     {
+        "name"           : "SLPM-65098 / SLPM-65631 - Saigo no Uta (v1.50)",
+
         "exepath"        : "SLPM_650.98",
         "execrc"         : 0x1388A129,
         "toc_offset"     : 0x2CCB80,
@@ -104,6 +169,8 @@ metalist = [
     # SLKA-25001 (v1.01)
     # Executable timestamp: 2002-12-09 08:22:06 GMT+0900
     {
+        "name"           : "SLKA-25001 (v1.01)",
+
         "exepath"        : "SLKA_250.01",
         "execrc"         : 0x0DE91246,
         "toc_offset"     : 0x2CD080,
@@ -123,6 +190,8 @@ metalist = [
     # SLUS-20228 (v1.20)
     # Executable timestamp: 2001-08-14 15:13:52 GMT+0900
     {
+        "name"           : "SLUS-20228 (v1.20)",
+
         "exepath"        : "SLUS_202.28",
         "execrc"         : 0xAA6B485D,
         "toc_offset"     : 0x2BB180,
@@ -142,6 +211,8 @@ metalist = [
     # SLUS-20228GH - Greatest Hits (v2.01)
     # Executable timestamp: 2002-07-11 05:18:18 GMT+0900
     {
+        "name"           : "SLUS-20228GH - Greatest Hits (v2.01)",
+
         "exepath"        : "SLUS_202.28",
         "execrc"         : 0xB6DA54E6,
         "toc_offset"     : 0x2CCF00,
@@ -161,6 +232,8 @@ metalist = [
     # SLES-50382 - Special Edition / The Collection (v1.10)
     # Executable timestamp: 2001-10-01 08:46:52 GMT+0900
     {
+        "name"           : "SLES-50382 - Special Edition / The Collection (v1.10)",
+
         "exepath"        : "SLES_503.82",
         "execrc"         : 0xD3402685,
         "toc_offset"     : 0x2BD400,
@@ -180,6 +253,8 @@ metalist = [
     # SLES-51156 - Director's Cut (v1.02)
     # Executable timestamp: 2002-11-07 10:15:08 GMT+0900
     {
+        "name"           : "SLES-51156 - Director's Cut (v1.02)",
+
         "exepath"        : "SLES_511.56",
         "execrc"         : 0xE6CFE16F,
         "toc_offset"     : 0x2CD980,
@@ -197,6 +272,629 @@ metalist = [
     }
 ]
 
+#
+# Detection index: exepath -> execrc -> metalist entries, so that every
+# candidate executable only has to be hashed once
+#
+detect_index = {}
+for meta in metalist:
+    detect_index.setdefault(meta["exepath"], {}).setdefault(meta["execrc"], []).append(meta)
+
+# budget of the decompressed block cache of compressed images
+BLOCK_CACHE_SIZE = 64 << 20
+
+# uncompressed distance between the inflater checkpoints of gzip images
+GZIP_SPAN = 8 << 20
+
+# data kept behind the read position of a streamed image, and the largest
+# gap a seekable one reads through rather than seeking over
+STREAM_WINDOW = 32 << 20
+STREAM_GAP = 0x100000
+
+# maps XA submode bytes to 1 for Form 2, 0 for Form 1
+XA_FORMS = bytes(1 if i & 0b100000 else 0 for i in range(256))
+
+# budget of the sector cache of an image, and the largest read it serves
+SECTOR_CACHE_SIZE = 16 << 20
+SECTOR_CACHE_READ = 0x8000
+
+# with --low-memory: the size of the windows files are hashed and read
+# through, how many windows of the executable and IRX are kept, and the
+# budget of the sector and block caches. Every other buffer shrinks to a
+# window too: the copy buffers (--io-depth of them), reads from the image,
+# store entries hashed in memory and decoded sound, and a streamed image
+# keeps LOW_MEMORY_WINDOWS windows behind its read position. Images aren't
+# mapped. What an extraction job holds of the image is then bounded by
+# about 2 * LOW_MEMORY_CACHE + (LOW_MEMORY_WINDOWS + io_depth + 2) *
+# LOW_MEMORY_WINDOW, some 3 MiB with the defaults, plus the inflater
+# checkpoints of a gzip image (see GZIP_SPAN); the plan itself and the
+# interpreter come on top.
+LOW_MEMORY_WINDOW = 0x10000
+LOW_MEMORY_WINDOWS = 8
+LOW_MEMORY_CACHE = 1 << 20
+
+def pread(f, size, pos, lock):
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), size, pos)
+    with lock:
+        f.seek(pos)
+        return f.read(size)
+
+class LRU_CACHE:
+    #
+    # Least-recently-used cache, bounded by the total length of the cached
+    # values rather than their count. Safe to share between threads.
+    #
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                self.size -= len(self.items.popitem(last=False)[1])
+
+class CSO_IMAGE:
+    #
+    # Block compressed images: CSO v1 (deflate), CSO v2 (deflate and LZ4,
+    # per block) and ZSO (LZ4). Only the block index is loaded up front,
+    # blocks are decompressed on demand and kept in an LRU cache.
+    #
+    def __init__(self, f, cache_size=BLOCK_CACHE_SIZE):
+        self.f = f
+        self.lock = threading.Lock()
+        self.cache = LRU_CACHE(cache_size)
+
+        header = pread(f, 0x18, 0, self.lock)
+
+        self.magic = header[0:4]
+        self.size, self.block_size, self.version, self.align = struct.unpack_from("<QIBB", header, 0x08)
+
+        if self.block_size <= 0 or self.block_size & (self.block_size - 1):
+            raise ValueError("Bad CSO block size: %d" % self.block_size)
+
+        if self.magic == b"ZISO" or self.version >= 2:
+            if lz4 is None:
+                raise ValueError("%s v%d images require the lz4 module" % (self.magic.decode(), self.version))
+
+        count = (self.size + self.block_size - 1) // self.block_size
+
+        index = pread(f, (count + 1) * 4, 0x18, self.lock)
+
+        if len(index) < (count + 1) * 4:
+            raise ValueError("Truncated CSO block index")
+
+        self.index = struct.unpack("<%dI" % (count + 1), index)
+
+    def block_end(self, block):
+        return min(self.size, (block + 1) * self.block_size)
+
+    def unlz4(self, data, size):
+        # unlike deflate, LZ4 can't ignore the alignment padding after a
+        # block, and there's no telling how much of it there is
+        for pad in range(min(len(data), 1 << self.align)):
+            try:
+                return lz4.block.decompress(data[:len(data)-pad], uncompressed_size=size)
+            except lz4.block.LZ4BlockError:
+                pass
+        raise ValueError("Bad LZ4 block")
+
+    def decompress(self, block, data):
+        flag = self.index[block] & 0x80000000
+        size = self.block_end(block) - block * self.block_size
+
+        if self.magic == b"ZISO":
+            if flag:
+                return data[:size]
+            return self.unlz4(data, size)
+
+        if self.version >= 2:
+            # v2 stores blocks that don't shrink as they are, and flags LZ4
+            if len(data) >= self.block_size:
+                return data[:size]
+            if flag:
+                return self.unlz4(data, size)
+        elif flag:
+            return data[:size]
+
+        # raw deflate; the index alignment may leave padding after the stream
+        return zlib.decompressobj(-15).decompress(data, size)
+
+    def load(self, first, count):
+        #
+        # Reads blocks [first, first+count) in one go, since they are stored
+        # back to back, and caches them
+        #
+        start = (self.index[first] & 0x7FFFFFFF) << self.align
+        end = (self.index[first + count] & 0x7FFFFFFF) << self.align
+
+        data = pread(self.f, end - start, start, self.lock)
+
+        blocks = []
+        for block in range(first, first + count):
+            a = ((self.index[block] & 0x7FFFFFFF) << self.align) - start
+            b = ((self.index[block + 1] & 0x7FFFFFFF) << self.align) - start
+            blocks.append(self.decompress(block, data[a:b]))
+            self.cache.put(block, blocks[-1])
+
+        return blocks
+
+    def readinto(self, pos, buf):
+        out = memoryview(buf).cast("B")
+        done = 0
+
+        while done < len(out) and pos < self.size:
+            block, skip = divmod(pos, self.block_size)
+
+            data = self.cache.get(block)
+
+            if data is None:
+                # fetch every block up to the end of the request at once
+                last = (min(self.size, pos + len(out) - done) - 1) // self.block_size
+                data = self.load(block, min(last - block + 1, 512))[0]
+
+            n = min(len(data) - skip, len(out) - done)
+            if n <= 0:
+                break
+            out[done:done+n] = data[skip:skip+n]
+            done += n
+            pos += n
+
+        return done
+
+class GZIP_IMAGE:
+    #
+    # gzip compressed images. A deflate stream can't be entered at arbitrary
+    # offsets, so as the image is read through, the inflater state is saved
+    # every GZIP_SPAN bytes of output; reads then resume from the nearest
+    # checkpoint rather than from the start of the stream. Decompressed data
+    # is cached in 256 KiB blocks.
+    #
+    def __init__(self, f, cache_size=BLOCK_CACHE_SIZE):
+        self.f = f
+        self.lock = threading.Lock()
+        self.cache = LRU_CACHE(cache_size)
+        self.block_size = 0x40000
+
+        # (uncompressed offset, compressed offset, inflater)
+        self.points = [(0, 0, zlib.decompressobj(31))]
+        self.offsets = [0]
+
+        #
+        # The trailer only holds the size modulo 4 GiB. An image that wrapped
+        # is still unlikely to end up smaller than its compressed data, so go
+        # with the first candidate that isn't. The size becomes exact once
+        # the end of the stream is reached.
+        #
+        csize = os.fstat(f.fileno()).st_size
+        self.size = struct.unpack("<I", pread(f, 4, csize - 4, self.lock))[0]
+        while self.size < csize - 0x10000:
+            self.size += 0x100000000
+        self.exact = 0
+
+    def inflate(self, block):
+        bs = self.block_size
+        start = block * bs
+        found = None
+
+        with self.lock:
+            i = bisect.bisect_right(self.offsets, start) - 1
+            upos, cpos, inflater = self.points[i]
+            inflater = inflater.copy()
+
+        pending = bytearray()
+        eof = 0
+
+        while upos < start + bs and not eof:
+            # small input steps of at most a block of output, as deflate can
+            # expand them a thousandfold; input left over is read again
+            chunk = pread(self.f, 0x8000, cpos, self.lock)
+
+            if chunk:
+                data = inflater.decompress(chunk, bs)
+                # (at the end of a member, what's left is in unused_data)
+                cpos += len(chunk) - (0 if inflater.eof else len(inflater.unconsumed_tail))
+            else:
+                # truncated stream, keep whatever it had
+                data = inflater.flush()
+                eof = 1
+
+            if inflater.eof:
+                # concatenated members continue the same image
+                cpos -= len(inflater.unused_data)
+                if inflater.unused_data[:2] == b"\x1f\x8b":
+                    inflater = zlib.decompressobj(31)
+                else:
+                    eof = 1
+
+            pending += data
+            upos += len(data)
+
+            if not eof:
+                with self.lock:
+                    if upos >= self.offsets[-1] + GZIP_SPAN:
+                        self.points.append((upos, cpos, inflater.copy()))
+                        self.offsets.append(upos)
+
+            # hand over whole blocks; the lead-in before the first block
+            # boundary belongs to a block this pass didn't start at
+            base = upos - len(pending)
+            first = -(-base // bs) * bs
+            while first + bs <= upos:
+                data = bytes(pending[first-base:first-base+bs])
+                if first == start:
+                    found = data
+                self.cache.put(first // bs, data)
+                first += bs
+            del pending[:max(0, first-base)]
+
+        if eof:
+            with self.lock:
+                self.size = upos
+                self.exact = 1
+            base = upos - len(pending)
+            first = -(-base // bs) * bs
+            if first < upos:
+                data = bytes(pending[first-base:])
+                if first == start:
+                    found = data
+                self.cache.put(first // bs, data)
+
+        return found
+
+    def readinto(self, pos, buf):
+        out = memoryview(buf).cast("B")
+        done = 0
+
+        while done < len(out) and pos < self.size:
+            block, skip = divmod(pos, self.block_size)
+
+            data = self.cache.get(block)
+
+            if data is None:
+                data = self.inflate(block)
+                if data is None:
+                    break
+
+            n = min(len(data) - skip, len(out) - done)
+            if n <= 0:
+                break
+            out[done:done+n] = data[skip:skip+n]
+            done += n
+            pos += n
+
+        return done
+
+class STREAM_IMAGE:
+    #
+    # Images read front to back, for sequential extraction: the image is
+    # read in `chunk` pieces into a window of the last `window` bytes
+    # (CHUNK_SIZE and STREAM_WINDOW by default), so reads in order of
+    # position coalesce into large sequential
+    # reads, and gaps of up to STREAM_GAP are read through instead of
+    # seeked over. Pipes can only be read this way; until stream() is
+    # called, what a pipe yields is spooled to a temporary file, so opening
+    # and planning may read it in any order.
+    #
+    def __init__(self, f, size=0, window=STREAM_WINDOW, chunk=CHUNK_SIZE):
+        self.f = f
+        self.lock = threading.Lock()
+        self.seekable = f.seekable()
+        self.streaming = 0
+
+        self.size = size
+        self.exact = self.seekable
+
+        # bytes consumed from a pipe, the first `spooled` of them kept
+        self.spool = None
+        self.spooled = 0
+        self.end = 0
+        if not self.seekable:
+            self.spool = tempfile.TemporaryFile()
+
+        self.window = bytearray()
+        self.window_pos = 0
+        self.window_size = window
+        self.chunk = chunk
+
+    def stream(self):
+        with self.lock:
+            self.streaming = 1
+            self.window_pos = self.end
+
+    def fill(self, end):
+        #
+        # Consumes the image up to position `end`, into the spool or the
+        # window
+        #
+        while self.end < end and not (self.exact and self.end >= self.size):
+            if self.seekable:
+                self.f.seek(self.end)
+            data = self.f.read(self.chunk)
+
+            if not data:
+                self.size = self.end
+                self.exact = 1
+                break
+
+            if not self.streaming:
+                self.spool.seek(self.end)
+                self.spool.write(data)
+                self.spooled += len(data)
+            else:
+                self.window += data
+                excess = len(self.window) - self.window_size
+                if excess > 0:
+                    del self.window[:excess]
+                    self.window_pos += excess
+
+            self.end += len(data)
+            if not self.exact:
+                self.size = max(self.size, self.end)
+
+    def readinto(self, pos, buf):
+        out = memoryview(buf).cast("B")
+        done = 0
+
+        with self.lock:
+            if not self.streaming:
+                if self.seekable:
+                    self.f.seek(pos)
+                    return self.f.readinto(out)
+                self.fill(pos + len(out))
+
+            if pos < self.spooled:
+                self.spool.seek(pos)
+                done = self.spool.readinto(out[:min(len(out), self.spooled - pos)])
+                pos += done
+                if done == len(out) or not self.streaming:
+                    return done
+
+            if pos < self.window_pos:
+                if not self.seekable:
+                    raise ValueError("Can't read %d bytes back in a pipe" % (self.end - pos))
+                self.f.seek(pos)
+                return done + self.f.readinto(out[done:])
+
+            if self.seekable and pos > self.end + STREAM_GAP:
+                # too far ahead to read through, start over there
+                self.window = bytearray()
+                self.window_pos = self.end = pos
+
+            self.fill(pos + len(out) - done)
+
+            skip = pos - self.window_pos
+            n = max(0, min(len(out) - done, len(self.window) - skip))
+            out[done:done+n] = self.window[skip:skip+n]
+
+        return done + n
+
+class XA_FORM_INDEX:
+    #
+    # Where the User Data of a CD-ROM XA extent lies, as runs of sectors of
+    # the same Form: the first sector of every run (relative to the start of
+    # the extent), the User Data offset it starts at and its User Data size
+    # per sector. Built lazily, only as far into the extent as asked for, so
+    # a seek costs a bisect instead of a walk over every sector before it.
+    #
+    def __init__(self, disk, start, state=None):
+        self.disk = disk
+        self.start = start
+
+        if state is None:
+            state = {"sectors":[], "offsets":[], "sizes":[], "count":0, "end":0, "eof":0}
+
+        self.sectors = state["sectors"]
+        self.offsets = state["offsets"]
+        self.sizes = state["sizes"]
+
+        # sectors scanned so far, and the User Data offset following them
+        self.count = state["count"]
+        self.end = state["end"]
+        self.eof = state["eof"]
+
+    def state(self):
+        return {
+            "sectors" : self.sectors,
+            "offsets" : self.offsets,
+            "sizes"   : self.sizes,
+            "count"   : self.count,
+            "end"     : self.end,
+            "eof"     : self.eof,
+        }
+
+    def scan(self):
+        #
+        # Indexes the next CHUNK_SIZE (LOW_MEMORY_WINDOW) worth of sectors.
+        # The submode bytes of the whole chunk are picked out with one strided
+        # slice, and runs of the same Form found with a regex, so no
+        # per-sector Python code runs.
+        #
+        disk = self.disk
+        sector_size = disk.sector_size
+        count = (LOW_MEMORY_WINDOW if disk.low_memory else CHUNK_SIZE) // sector_size
+
+        pos = (self.start + self.count) * sector_size
+
+        if disk.mm is not None:
+            submodes = disk.mv[pos+0x12:pos+count*sector_size:sector_size].tobytes()
+            if metrics is not None:
+                metrics.read(len(submodes) * sector_size)
+        else:
+            submodes = disk.read_raw(pos, count * sector_size)[0x12::sector_size]
+
+        if len(submodes) < count:
+            self.eof = 1
+
+        for run in re.finditer(b"\x00+|\x01+", submodes.translate(XA_FORMS)):
+            size = 2324 if submodes[run.start()] & 0b100000 else 2048
+            if not self.sizes or self.sizes[-1] != size:
+                self.sectors.append(self.count)
+                self.offsets.append(self.end)
+                self.sizes.append(size)
+            length = run.end() - run.start()
+            self.count += length
+            self.end += length * size
+
+    def locate(self, offset):
+        #
+        # Sector (relative to the start of the extent) holding User Data byte
+        # `offset`, and the offset into its User Data
+        #
+        while self.end <= offset and not self.eof:
+            self.scan()
+
+        if not self.sectors:
+            return divmod(offset, 2048)
+
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        sector, rest = divmod(offset - self.offsets[i], self.sizes[i])
+
+        return self.sectors[i] + sector, rest
+
+class RECORD:
+    #
+    # Base of the slotted records there are thousands of (directory records,
+    # plan entries). They index like the dicts they used to be
+    # (record["lba"], dict(record)).
+    #
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def keys(self):
+        return self.__slots__
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % (key, getattr(self, key)) for key in self.__slots__))
+
+class ISOFS_RECORD(RECORD):
+    #
+    # A directory record: `size` bytes at sector `lba`. A file recorded in
+    # several extents (> 4 GiB on a DVD) has one record, whose `extents`
+    # are the (lba, size) of each.
+    #
+    __slots__ = ("lba", "size", "flags", "name", "extents")
+
+    def __init__(self, lba, size, flags, name):
+        self.lba = lba
+        self.size = size
+        self.flags = flags
+        self.name = name
+        self.extents = ((lba, size),)
+
+def iso_normpath(path):
+    path = path.replace("\\", "/").lstrip("/")
+    while path.startswith("./"):
+        path = path[2:].lstrip("/")
+    return path.upper()
+
+class ISOFS_INDEX:
+    #
+    # The directory tree of an ISOFS_IMAGE, as a read-only mapping of file
+    # paths ("DIR/FILE.EXT", optionally led by "/" or "./", in any case) to
+    # ISOFS_RECORDs. A directory is only read when a lookup first goes
+    # through it, so opening an image to get at one file costs just the
+    # directories on its path.
+    #
+    def __init__(self, disk, root):
+        self.disk = disk
+        self.root = root
+
+        # ISOFS_RECORDs of every directory read so far, by upper-case name,
+        # by starting sector of the directory
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def listdir(self, record):
+        entries = self.dirs.get(record.lba)
+        if entries is None:
+            with self.lock:
+                entries = self.dirs.get(record.lba)
+                if entries is None:
+                    dirbuf = self.disk.read_user_at(self.disk.user_pos(record.lba), record.size)
+                    entries = self.dirs[record.lba] = self.disk.dirparse(dirbuf)
+        return entries
+
+    def find(self, path):
+        record = self.root
+        for name in iso_normpath(path).split("/"):
+            if not record.flags & 0b10:
+                return None
+            record = self.listdir(record).get(name)
+            if record is None:
+                return None
+        return record
+
+    def get(self, path, default=None):
+        record = self.find(path)
+        if record is None or record.flags & 0b10:
+            return default
+        return record
+
+    def __getitem__(self, path):
+        record = self.get(path)
+        if record is None:
+            raise KeyError(path)
+        return record
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def items(self, record=None, dirname=""):
+        #
+        # (path, ISOFS_RECORD) of every file below the directory `record`,
+        # reading whatever directories haven't been yet
+        #
+        subdirs = []
+        for child in self.listdir(record or self.root).values():
+            if child.flags & 0b10:
+                subdirs.append(child)
+            else:
+                yield dirname + child.name, child
+        for child in subdirs:
+            yield from self.items(child, dirname + child.name + "/")
+
+    def keys(self):
+        return (path for path, record in self.items())
+
+    def values(self):
+        return (record for path, record in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(1 for path, record in self.items())
+
+    def load(self):
+        for path, record in self.items():
+            pass
+
 class ISOFS_IMAGE:
     #
     # DISCLAIMER:
@@ -204,18 +902,101 @@ class ISOFS_IMAGE:
     # on NON-mixed-mode disk images.
     # -- Nisto
     #
-    def __init__(self, path):
+    def __init__(self, path, use_mmap=True, cache_size=SECTOR_CACHE_SIZE, io_depth=IO_DEPTH, io_buffer=IO_BUFFER, low_memory=0):
         self.path = path
 
-        self.f = open(self.path, "rb")
-
-        self.toc = {}
-
-        self.f.seek(16 * 2352)
-        pvd_raw = self.f.read(2352)
-
-        self.f.seek(16 * 2048)
-        pvd_user = self.f.read(2048)
+        # to open the image again the same way, see decode_init()
+        self.options = {
+            "use_mmap"   : use_mmap,
+            "cache_size" : cache_size,
+            "io_depth"   : io_depth,
+            "io_buffer"  : io_buffer,
+            "low_memory" : low_memory,
+        }
+
+        # keep to small, fixed buffers and caches, see LOW_MEMORY_WINDOW
+        self.low_memory = low_memory
+        if low_memory:
+            cache_size = min(cache_size, LOW_MEMORY_CACHE)
+            io_buffer = min(io_buffer, LOW_MEMORY_WINDOW)
+            use_mmap = False
+        block_cache = LOW_MEMORY_CACHE if low_memory else BLOCK_CACHE_SIZE
+
+        # largest single read from the image, and the size of the pieces
+        # sound is decoded and files are archived in
+        self.chunk_size = LOW_MEMORY_WINDOW if low_memory else CHUNK_SIZE
+
+        # see copy_chunks()
+        self.io_depth = io_depth
+        self.io_buffer = io_buffer
+
+        # outputs are named after the image, see out_root()
+        # (X.iso.gz gets the same names as X.iso)
+        self.base, ext = os.path.splitext(path)
+        if ext.lower() == ".gz" and os.path.splitext(self.base)[1].lower() in IMAGE_EXTS:
+            self.base = os.path.splitext(self.base)[0]
+
+        if path == "-":
+            self.f = open(sys.stdin.fileno(), "rb", closefd=False)
+        else:
+            self.f = open(self.path, "rb")
+
+        self.seekable = self.f.seekable()
+
+        self.size = os.fstat(self.f.fileno()).st_size
+
+        # serializes seek+read on platforms without pread
+        self.lock = threading.Lock()
+
+        #
+        # Compressed images are read through a source that decompresses on
+        # demand; everything below works on the decompressed image
+        #
+        self.src = None
+        magic = pread(self.f, 4, 0, self.lock) if self.seekable else b""
+        try:
+            if not self.seekable:
+                self.src = self.stream_image(0)
+            elif magic in (b"CISO", b"ZISO"):
+                self.src = CSO_IMAGE(self.f, block_cache)
+            elif magic[:2] == b"\x1f\x8b":
+                self.src = GZIP_IMAGE(self.f, block_cache)
+        except ValueError:
+            self.f.close()
+            raise
+        if self.src is not None:
+            self.size = self.src.size
+            use_mmap = False
+
+        #
+        # Map the whole image so sectors can be sliced straight out of the
+        # page cache instead of going through read() calls. Empty files,
+        # non-regular files and images larger than the address space (32-bit
+        # builds) can't be mapped, and fall back to regular reads.
+        #
+        self.mm = None
+        self.mv = None
+        if use_mmap:
+            try:
+                self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mv = memoryview(self.mm)
+            except (ValueError, OSError, OverflowError):
+                pass
+
+        # current (raw) position in the image
+        self.pos = 0
+
+        # raw sectors of small reads, keyed by index; enabled once the sector
+        # size is known
+        self.cache = None
+
+        # XA_FORM_INDEX of every extent seeked into, by starting sector
+        self.xa_index = {}
+        self.xa_lock = threading.Lock()
+
+        pvd_raw = self.read_raw(16 * 2352, 2352)
+
+        pvd_user = self.read_raw(16 * 2048, 2048)
 
         if self.is_raw_sector(pvd_raw) and self.is_pvd(pvd_raw[0x10:0x810]):
             #
@@ -258,16 +1039,27 @@ class ISOFS_IMAGE:
             self.user_size = 2048
             self.user_end = 2048
         else:
-            print("Unrecognized disk image format")
-            sys.exit(1)
+            self.close()
+            raise ValueError("Unrecognized disk image format")
 
-        root_dr = self.drparse(pvd[0x9C:0xBE])
+        #
+        # Directory records, bank headers, XA subheaders and the like are read
+        # in small pieces, often more than once. A mapped image already has
+        # them in the page cache, anything else gets a cache of its own.
+        #
+        if self.mm is None:
+            self.cache = LRU_CACHE(cache_size)
 
-        self.seek_user(root_dr["lba"])
+        # a gzip trailer can't tell sizes 4 GiB apart, the volume size can
+        if isinstance(self.src, (GZIP_IMAGE, STREAM_IMAGE)) and not self.src.exact:
+            self.size = max(self.size, get_u32_le(pvd, 80) * self.sector_size)
+            self.src.size = self.size
 
-        root_dir = self.read_user(root_dr["size"])
+        self.toc = ISOFS_INDEX(self, self.drparse(pvd[0x9C:0xBE]))
 
-        self.dirparse(root_dir)
+        # a pipe can't go back for the directories later
+        if not self.seekable:
+            self.toc.load()
 
     def is_raw_sector(self, buf):
         sync = buf[0x00:0x0C]
@@ -302,106 +1094,430 @@ class ISOFS_IMAGE:
 
         return 1
 
-    def set_xa(self, subcode):
-        if subcode & 0b100000 == 0:
-            self.user_size = 2048
-            self.user_end = 0x818
+    def user_end_at(self, pos):
+        #
+        # End offset of the User Data in the sector at raw position `pos`.
+        # For CD-ROM XA this depends on the Form given by the subheader.
+        #
+        if not self.is_xa:
+            return self.user_end
+        submode = self.read_raw(pos - pos % self.sector_size + 0x12, 1)[0]
+        if submode & 0b100000 == 0:
+            return 0x818
+        else:
+            return 0x92C
+
+    def stream_image(self, size):
+        if self.low_memory:
+            return STREAM_IMAGE(self.f, size, LOW_MEMORY_WINDOW * LOW_MEMORY_WINDOWS, LOW_MEMORY_WINDOW)
+        return STREAM_IMAGE(self.f, size)
+
+    def stream(self):
+        #
+        # Switches to reading the image front to back (see STREAM_IMAGE);
+        # from here on, reads should come in order of position. Mapped and
+        # compressed images are left as they are.
+        #
+        if self.mm is not None:
+            return
+        if self.src is None:
+            self.src = self.stream_image(self.size)
+        if isinstance(self.src, STREAM_IMAGE):
+            self.src.stream()
+            # the window holds everything the sector cache would
+            self.cache = None
+
+    def close(self):
+        if self.mm is not None:
+            self.mv.release()
+            self.mm.close()
+            self.mv = None
+            self.mm = None
+        self.f.close()
+
+    def read_raw(self, pos, size):
+        if self.mm is not None:
+            data = self.mm[pos:pos+size]
+            if metrics is not None:
+                metrics.read(len(data))
+            return data
+        buf = bytearray(max(0, size))
+        return bytes(buf[:self.readinto_raw(pos, buf)])
+
+    def readinto_raw(self, pos, buf):
+        if self.mm is not None:
+            size = min(len(buf), self.size - pos)
+            if size <= 0:
+                return 0
+            buf[:size] = self.mv[pos:pos+size]
+            if metrics is not None:
+                metrics.read(size)
+            return size
+        if self.cache is not None and len(buf) <= SECTOR_CACHE_READ:
+            return self.readinto_cached(pos, buf)
+        return self.readinto_file(pos, buf)
+
+    def readinto_cached(self, pos, buf):
+        out = memoryview(buf)
+        sector_size = self.sector_size
+        done = 0
+
+        while done < len(out):
+            index, skip = divmod(pos + done, sector_size)
+
+            sect = self.cache.get(index)
+
+            if sect is None:
+                sect = bytearray(sector_size)
+                sect = bytes(sect[:self.readinto_file(index * sector_size, sect)])
+                self.cache.put(index, sect)
+
+            n = min(len(sect) - skip, len(out) - done)
+            if n <= 0:
+                break
+            out[done:done+n] = sect[skip:skip+n]
+            done += n
+
+        return done
+
+    def readinto_file(self, pos, buf):
+        if self.src is not None:
+            size = self.src.readinto(pos, buf)
+        elif hasattr(os, "preadv"):
+            size = os.preadv(self.f.fileno(), [buf], pos)
         else:
-            self.user_size = 2324
-            self.user_end = 0x92C
+            with self.lock:
+                self.f.seek(pos)
+                size = self.f.readinto(buf)
+        if metrics is not None:
+            metrics.read(size)
+        return size
 
-    def read_user(self, size):
-        usrbuf = b""
-        if self.is_raw:
-            offset_in_sector = self.f.tell() % self.sector_size
-            if offset_in_sector != 0:
-                if offset_in_sector < self.user_start:
-                    self.f.seek(-offset_in_sector, os.SEEK_CUR)
-                else:
-                    if self.is_xa:
-                        self.f.seek(-offset_in_sector, os.SEEK_CUR)
-                        tmpbuf = self.f.read(offset_in_sector)
-                        self.set_xa(tmpbuf[0x12])
-
-                    if offset_in_sector < self.user_end:
-                        user_remain = self.user_end - offset_in_sector
-
-                        if size < user_remain:
-                            return self.f.read(size)
-
-                        usrbuf += self.f.read(user_remain)
-
-                        size -= user_remain
-
-                        self.f.seek(self.sector_size - (offset_in_sector + user_remain), os.SEEK_CUR)
-                    else:
-                        self.f.seek(self.sector_size - offset_in_sector, os.SEEK_CUR)
-
-            if self.is_xa:
-                while size > 0:
-                    sectbuf = self.f.read(self.sector_size)
-                    self.set_xa(sectbuf[0x12])
-                    if size >= self.user_size:
-                        usrbuf += sectbuf[self.user_start:self.user_end]
-                        size -= self.user_size
-                    else:
-                        usrbuf += sectbuf[self.user_start:self.user_start+size]
-                        self.f.seek(-self.sector_size + self.user_start + size, os.SEEK_CUR)
-                        size = 0
-            else:
-                while size > 0:
-                    if size >= self.user_size:
-                        sectbuf = self.f.read(self.sector_size)
-                        size -= self.user_size
-                    else:
-                        sectbuf = self.f.read(self.user_start + size)
-                        size = 0
-                    usrbuf += sectbuf[self.user_start:self.user_end]
+    def readinto_user_at(self, pos, buf):
+        #
+        # Fills `buf` with User Data starting at the raw position `pos`.
+        # Doesn't touch any state of the image, so it may be called from any
+        # number of threads at once. Returns the number of bytes read and the
+        # raw position following them.
+        #
+        out = memoryview(buf)
+        size = len(out)
+        done = 0
+
+        if not self.is_raw:
+            done = self.readinto_raw(pos, out)
+            return done, pos + done
+
+        while done < size and pos < self.size:
+            sect_pos = pos - pos % self.sector_size
+            offset_in_sector = pos - sect_pos
+
+            if offset_in_sector <= self.user_start and size - done >= 2048:
+                got, pos = self.readinto_sectors(sect_pos, out[done:])
+                done += got
+                if got > 0:
+                    continue
+
+            user_end = self.user_end_at(sect_pos)
+
+            if offset_in_sector < self.user_start:
+                offset_in_sector = self.user_start
+
+            if offset_in_sector >= user_end:
+                pos = sect_pos + self.sector_size
+                continue
+
+            todo = min(user_end - offset_in_sector, size - done)
+
+            got = self.readinto_raw(sect_pos + offset_in_sector, out[done:done+todo])
+
+            done += got
+
+            pos = sect_pos + offset_in_sector + got
+
+            if got < todo:
+                break
+
+            if offset_in_sector + got == user_end:
+                pos = sect_pos + self.sector_size
+
+        return done, pos
+
+    def readinto_user(self, buf):
+        done, self.pos = self.readinto_user_at(self.pos, buf)
+        return done
+
+    def readinto_sectors(self, pos, out):
+        #
+        # Copies the User Data of as many whole sectors as fit in `out`,
+        # starting at the (sector aligned) raw position `pos`, stripping the
+        # sync/header/subheader/EDC/ECC fields of a whole batch of sectors per
+        # call. Returns the number of bytes copied and the new raw position.
+        #
+        sector_size = self.sector_size
+        user_start = self.user_start
+
+        if self.is_xa:
+            count = len(out) // 2048
         else:
-            while size > 0:
-                if size >= self.user_size:
-                    usrbuf += self.f.read(self.user_size)
-                    size -= self.user_size
+            count = len(out) // self.user_size
+
+        count = min(count, self.chunk_size // 2048, (self.size - pos) // sector_size)
+        if count <= 0:
+            return 0, pos
+
+        if self.mm is not None:
+            src = self.mv[pos:pos+count*sector_size]
+            if metrics is not None:
+                metrics.read(len(src))
+        else:
+            src = memoryview(bytearray(count * sector_size))
+            count = self.readinto_raw(pos, src) // sector_size
+
+        done = 0
+
+        if self.is_xa:
+            avail = len(out)
+            for i in range(count):
+                sect = i * sector_size
+                if src[sect+0x12] & 0b100000 == 0:
+                    user_end = 0x818
                 else:
-                    usrbuf += self.f.read(size)
-                    size = 0
+                    user_end = 0x92C
+                user_size = user_end - user_start
+                if done + user_size > avail:
+                    break
+                out[done:done+user_size] = src[sect+user_start:sect+user_end]
+                done += user_size
+                pos += sector_size
+        else:
+            user_size = self.user_size
+            user_end = self.user_end
+            for i in range(count):
+                sect = i * sector_size
+                out[done:done+user_size] = src[sect+user_start:sect+user_end]
+                done += user_size
+            pos += count * sector_size
+
+        return done, pos
+
+    def read_user_at(self, pos, size):
+        usrbuf = bytearray(size)
+
+        got, pos = self.readinto_user_at(pos, usrbuf)
+        if got < size:
+            del usrbuf[got:]
 
         return usrbuf
 
-    def seek_user(self, sectors, bytes=0):
+    def read_user(self, size):
+        usrbuf = bytearray(size)
+
+        got = self.readinto_user(usrbuf)
+        if got < size:
+            del usrbuf[got:]
+
+        return usrbuf
+
+    def user_pos(self, sectors, bytes=0):
+        #
+        # Raw position of the User Data byte `bytes` bytes into the extent
+        # starting at sector `sectors`
+        #
+        if metrics is not None:
+            metrics.count("seeks")
         if self.is_xa:
-            self.f.seek(sectors * self.sector_size)
-            while bytes > 0:
-                header = self.f.read(self.user_start)
-                self.set_xa(header[0x12])
-                if bytes >= self.user_size:
-                    self.f.seek(self.sector_size - self.user_start, os.SEEK_CUR)
-                    bytes -= self.user_size
-                else:
-                    self.f.seek(bytes, os.SEEK_CUR)
-                    bytes = 0
+            if bytes <= 0:
+                return sectors * self.sector_size
+            with self.xa_lock:
+                index = self.xa_index.get(sectors)
+                if index is None:
+                    index = self.xa_index[sectors] = XA_FORM_INDEX(self, sectors)
+                sector, bytes = index.locate(bytes)
+            pos = (sectors + sector) * self.sector_size
+            if bytes > 0:
+                pos += self.user_start + bytes
+            return pos
         else:
             if self.is_raw and bytes > 0:
                 sectors += bytes // self.user_size
                 bytes = self.user_start + (bytes % self.user_size)
-            self.f.seek(sectors * self.sector_size + bytes)
+            return sectors * self.sector_size + bytes
 
-    def extract(self, outpath, size, raw=False):
+    def seek_user(self, sectors, bytes=0):
+        self.pos = self.user_pos(sectors, bytes)
+
+    def copy_raw(self, out, pos, size, hashes=()):
+        #
+        # Copies `size` bytes from the raw position `pos` of the image into
+        # the file object `out`. Lets the kernel move the data if it can
+        # (copy_file_range, then sendfile), otherwise falls back to large
+        # buffered copies. The data is fed to every object in `hashes`, which
+        # rules out the kernel copies, as do compressed images. Returns the
+        # number of bytes copied.
+        #
+        size = max(0, min(size, self.size - pos))
+        done = 0
+
+        out.flush()
+
+        if hashes or self.src is not None:
+            pass
+        elif hasattr(os, "copy_file_range"):
+            try:
+                while done < size:
+                    n = os.copy_file_range(self.f.fileno(), out.fileno(), size - done, pos + done)
+                    if n <= 0:
+                        break
+                    done += n
+                    if metrics is not None:
+                        metrics.read(n)
+                        metrics.write(n)
+            except OSError:
+                pass
+
+        if done < size and not hashes and self.src is None and hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            try:
+                while done < size:
+                    n = os.sendfile(out.fileno(), self.f.fileno(), pos + done, size - done)
+                    if n <= 0:
+                        break
+                    done += n
+                    if metrics is not None:
+                        metrics.read(n)
+                        metrics.write(n)
+            except OSError:
+                pass
+
+        if done < size and self.mm is not None:
+            #
+            # Slices of the mapping are written out as they are, no buffers
+            #
+            while done < size:
+                data = self.mv[pos+done:pos+done+min(CHUNK_SIZE, size - done)]
+                if metrics is not None:
+                    metrics.read(len(data))
+                if len(data) <= 0:
+                    break
+                for h in hashes:
+                    h.update(data)
+                out.write(data)
+                if metrics is not None:
+                    metrics.write(len(data))
+                done += len(data)
+        elif done < size:
+            start = pos + done
+            def read(buf, at):
+                return self.readinto_raw(start + at, buf)
+            done += self.copy_chunks(out, read, size - done, hashes)
+
+        return done
+
+    def copy_user(self, out, pos, size, hashes=()):
+        end = [pos]
+        def read(buf, at):
+            got, end[0] = self.readinto_user_at(end[0], buf)
+            return got
+        done = self.copy_chunks(out, read, size, hashes)
+        return done, end[0]
+
+    def copy_chunks(self, out, read, size, hashes=()):
+        #
+        # Copies `size` bytes to the file object `out`, from read(buf, done)
+        # calls that fill `buf` with the data following the first `done`
+        # bytes and return how much they filled. Data that takes more than
+        # one buffer goes through a ring of io_depth buffers of io_buffer
+        # bytes: while a writer thread drains full buffers into `out` (and
+        # `hashes`), the next ones are read, so that the image and the output
+        # are busy at the same time rather than taking turns. Returns the
+        # number of bytes copied.
+        #
+        bufsize = self.io_buffer
+        done = 0
+
+        if self.io_depth < 2 or size <= bufsize:
+            buf = memoryview(bytearray(min(size, bufsize)))
+            while done < size:
+                got = read(buf[:min(bufsize, size - done)], done)
+                if got <= 0:
+                    break
+                for h in hashes:
+                    h.update(buf[:got])
+                out.write(buf[:got])
+                if metrics is not None:
+                    metrics.write(got)
+                done += got
+            return done
+
+        free = queue.Queue()
+        full = queue.Queue()
+        for i in range(self.io_depth):
+            free.put(memoryview(bytearray(bufsize)))
+
+        errors = []
+
+        def writer():
+            while True:
+                item = full.get()
+                if item is None:
+                    break
+                buf, got = item
+                # after an error the buffers are only handed back
+                if not errors:
+                    try:
+                        for h in hashes:
+                            h.update(buf[:got])
+                        out.write(buf[:got])
+                        if metrics is not None:
+                            metrics.write(got)
+                    except BaseException as e:
+                        errors.append(e)
+                free.put(buf)
+
+        thread = threading.Thread(target=writer, name="sh2ex writer")
+        thread.start()
+
+        try:
+            while done < size and not errors:
+                buf = free.get()
+                got = read(buf[:min(bufsize, size - done)], done)
+                if got <= 0:
+                    free.put(buf)
+                    break
+                full.put((buf, got))
+                done += got
+        finally:
+            full.put(None)
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return done
+
+    def copy_at(self, out, pos, size, raw=False, hashes=()):
+        #
+        # Copies `size` bytes of data starting at the raw position `pos` into
+        # the file object `out`. Returns the raw position following the data.
+        #
+        if raw or not self.is_raw:
+            #
+            # The data is one contiguous run in the image file
+            #
+            return pos + self.copy_raw(out, pos, size, hashes)
+        done, pos = self.copy_user(out, pos, size, hashes)
+        return pos
+
+    def extract_at(self, outpath, pos, size, raw=False, hashes=()):
+        #
+        # Extracts `size` bytes of data starting at the raw position `pos` to
+        # `outpath`. Returns the raw position following the data.
+        #
         with open(outpath, "wb") as out:
-            while size > 0:
-                todo = 2048
-
-                if todo > size:
-                    todo = size
-
-                if raw:
-                    buf = self.f.read(todo)
-                else:
-                    buf = self.read_user(todo)
-
-                out.write(buf)
+            return self.copy_at(out, pos, size, raw, hashes)
 
-                size -= todo
+    def extract(self, outpath, size, raw=False):
+        self.pos = self.extract_at(outpath, self.pos, size, raw)
 
     def drparse(self, drbuf):
         dr_size = get_u8(drbuf, 0x00)
@@ -418,29 +1534,684 @@ class ISOFS_IMAGE:
         else:
             name = name.rsplit(';', 1)[0]
 
-        return {"lba":lba, "size":size, "flags":flags, "name":name}
-
-    def dirparse(self, dirbuf, dirname=''):
+        return ISOFS_RECORD(lba, size, flags, name)
+
+    def dirparse(self, dirbuf):
+        #
+        # Returns the records of a directory by upper-case name. Records
+        # don't cross sectors, so a zero length byte is padding up to the
+        # next sector, not the end of the directory. The records of a file
+        # in several extents (flag 0x80 on all but the last) are merged.
+        #
+        entries = {}
+        last = None
         i = 0
-        subdirs = []
-        while i < len(dirbuf) and dirbuf[i] > 0:
+        while i < len(dirbuf):
             dr_len = dirbuf[i]
 
-            record = self.drparse(dirbuf[i:i+dr_len])
+            if dr_len == 0:
+                i = (i // 2048 + 1) * 2048
+                continue
 
-            if record["flags"] & 0b10 != 0 and record["name"] != '.' and record["name"] != '..':
-                subdirs.append(record)
-            elif record["flags"] & 0b10 == 0:
-                self.toc[os.path.join('', dirname, record["name"]).replace(os.sep, '/')] = record
-                self.toc[os.path.join('/', dirname, record["name"]).replace(os.sep, '/')] = record
-                self.toc[os.path.join('./', dirname, record["name"]).replace(os.sep, '/')] = record
+            record = self.drparse(dirbuf[i:i+dr_len])
 
             i += dr_len
 
-        for record in subdirs:
-            self.seek_user(record["lba"])
-            dirbuf = self.read_user(record["size"])
-            self.dirparse(dirbuf, os.path.join(dirname, record["name"]))
+            if record.name == '.' or record.name == '..':
+                continue
+
+            if last is not None and last.name == record.name:
+                last.size += record.size
+                last.extents += record.extents
+                last.flags = record.flags
+                record = last
+
+            entries[record.name.upper()] = record
+
+            last = record if record.flags & 0x80 else None
+
+        return entries
+
+class ISOFS_FILE(io.RawIOBase):
+    #
+    # Read-only, seekable file object over `size` bytes of User Data,
+    # starting `offset` bytes into the extent at sector `lba` of an
+    # ISOFS_IMAGE, or into the first of `extents`, the (lba, size) of each
+    # extent of a file recorded in several. Data is only read from the image
+    # when asked for.
+    #
+    def __init__(self, disk, lba, offset, size, extents=None):
+        self.disk = disk
+        self.lba = lba
+        self.offset = offset
+        self.size = size
+        self.extents = extents or ((lba, offset + size),)
+
+        # offset of the next byte in the file
+        self.off = 0
+
+        # raw position of the next byte in the image, and the bytes left in
+        # its extent (None until needed)
+        self.pos = None
+        self.left = 0
+
+    def __len__(self):
+        return self.size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.off
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            off = offset
+        elif whence == os.SEEK_CUR:
+            off = self.off + offset
+        elif whence == os.SEEK_END:
+            off = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+
+        if off < 0:
+            raise ValueError("negative seek position %d" % off)
+
+        if off != self.off:
+            self.off = off
+            self.pos = None
+
+        return self.off
+
+    def runs(self, off, size):
+        #
+        # (raw position, size) of each contiguous run of the `size` bytes at
+        # offset `off` into the file
+        #
+        size = max(0, min(size, self.size - off))
+        off += self.offset
+        for lba, length in self.extents:
+            if size <= 0:
+                break
+            if off < length:
+                n = min(size, length - off)
+                yield self.disk.user_pos(lba, off), n
+                size -= n
+                off = 0
+            else:
+                off -= length
+
+    def readinto(self, buf):
+        #
+        # Fills `buf` as far as the file goes, which may take several reads
+        # from the image (at most disk.chunk_size bytes each, one extent at
+        # a time)
+        #
+        out = memoryview(buf).cast("B")
+        done = 0
+        while done < len(out) and self.off < self.size:
+            if self.pos is None:
+                run = next(self.runs(self.off, len(out) - done), None)
+                if run is None:
+                    break
+                self.pos, self.left = run
+            todo = min(len(out) - done, self.left)
+            got, self.pos = self.disk.readinto_user_at(self.pos, out[done:done+todo])
+            if got <= 0:
+                break
+            done += got
+            self.off += got
+            self.left -= got
+            if self.left <= 0:
+                self.pos = None
+        return done
+
+    def readall(self):
+        buf = bytearray(max(0, self.size - self.off))
+        got = self.readinto(buf)
+        del buf[got:]
+        return bytes(buf)
+
+class FILE_WINDOWS:
+    #
+    # Read-only, bytes-like stand-in for the contents of an ISOFS_FILE,
+    # which only holds the few windows of it that were touched last. Does
+    # len(), indexing, slicing and index() of a single byte, all that the
+    # TOC, IRX and HD table parsers need.
+    #
+    def __init__(self, file, window=LOW_MEMORY_WINDOW, count=LOW_MEMORY_WINDOWS):
+        self.file = file
+        self.size = len(file)
+        self.window = window
+        self.windows = LRU_CACHE(window * count)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, off, size):
+        self.file.seek(off)
+        return self.file.read(size)
+
+    def get(self, k):
+        data = self.windows.get(k)
+        if data is None:
+            data = self.read(k * self.window, self.window)
+            self.windows.put(k, data)
+        return data
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            if key < 0:
+                key += self.size
+            if not 0 <= key < self.size:
+                raise IndexError("index out of range")
+            return self.get(key // self.window)[key % self.window]
+        start, stop, step = key.indices(self.size)
+        if start >= stop:
+            return b""
+        k = start // self.window
+        if (stop - 1) // self.window == k:
+            base = k * self.window
+            return self.get(k)[start-base:stop-base]
+        return b"".join(self.get(i)[max(start-i*self.window, 0):stop-i*self.window] for i in range(k, (stop - 1) // self.window + 1))
+
+    def index(self, sub, start=0):
+        k = start // self.window
+        while k * self.window < self.size:
+            i = self.get(k).find(sub, max(start - k * self.window, 0))
+            if i >= 0:
+                return k * self.window + i
+            k += 1
+        raise ValueError("subsection not found")
+
+class ELF_IMAGE:
+    #
+    # Maps the virtual addresses of an executable to offsets into its file,
+    # through the program headers of all of its PT_LOAD segments
+    #
+    def __init__(self, buf):
+        e_phoff, = struct.unpack("<I", buf[0x1C:0x20])
+        e_phentsize, e_phnum = struct.unpack("<2H", buf[0x2A:0x2E])
+        e_phentsize = e_phentsize or 0x20
+
+        phdrs = buf[e_phoff:e_phoff+e_phnum*e_phentsize]
+
+        segments = []
+        for i in range(e_phnum):
+            p_type, p_offset, p_vaddr, p_paddr, p_filesz = struct.unpack_from("<5I", phdrs, i * e_phentsize)
+            if p_type == 1:
+                segments.append((p_vaddr, p_vaddr + p_filesz, p_offset))
+
+        if not segments:
+            # whatever the first program header maps
+            p_offset, p_vaddr = struct.unpack("<2I", buf[e_phoff+0x04:e_phoff+0x0C])
+            segments.append((p_vaddr, p_vaddr, p_offset))
+
+        segments.sort()
+        self.segments = segments
+        self.starts = [start for start, end, offset in segments]
+
+    def offset(self, address):
+        # addresses past a segment's file data are taken relative to it,
+        # like they were when only the first segment was looked at
+        i = bisect.bisect_right(self.starts, address) - 1
+        start, end, offset = self.segments[i if i > 0 else 0]
+        return offset + address - start
+
+class PLAN_ENTRY(RECORD):
+    #
+    # A file of the plan: `size` bytes of User Data, `offset` bytes into the
+    # extent at sector `lba` (of the disc file `src`, for VFS files)
+    #
+    __slots__ = ("kind", "path", "src", "lba", "offset", "size")
+
+    def __init__(self, kind, path, src, lba, offset, size):
+        self.kind = kind
+        self.path = path
+        self.src = src
+        self.lba = lba
+        self.offset = offset
+        self.size = size
+
+class SH2_IMAGE:
+    #
+    # Random access to the files of a supported disk image, without having
+    # to extract anything:
+    #
+    #   with SH2_IMAGE("SLUS_202.28.iso") as image:
+    #       with image.open("data/...") as f:
+    #           f.seek(0x10)
+    #           header = f.read(0x20)
+    #
+    # Files are looked up by their VFS path by default; root="sound" selects
+    # the TriggerData/Streams files, and root="disc" the ISO9660 filesystem.
+    #
+    def __init__(self, path, use_cache=True, low_memory=0):
+        self.path = os.path.realpath(path)
+
+        self.disk = ISOFS_IMAGE(self.path, low_memory=low_memory)
+
+        self.meta, self.plan = make_plan(self.disk, use_cache)
+
+        if self.plan is None:
+            self.disk.close()
+            raise ValueError("%s: unsupported version" % self.path)
+
+        self.entries = {}
+        for root in self.plan:
+            self.entries[root] = {}
+            for entry in self.plan[root]:
+                self.entries[root][self.normpath(entry["path"])] = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.disk.close()
+
+    def normpath(self, path):
+        return iso_normpath(path)
+
+    def names(self, root="vfs"):
+        if root == "disc":
+            return sorted(self.disk.toc)
+        return [entry["path"].replace(os.sep, "/") for entry in self.plan[root]]
+
+    def lookup(self, path, root="vfs"):
+        if root == "disc":
+            record = self.disk.toc.get(self.normpath(path))
+            if record is None:
+                return None
+            return {"path": path, "lba": record["lba"], "offset": 0, "size": record["size"], "extents": record["extents"]}
+        return self.entries[root].get(self.normpath(path))
+
+    def __contains__(self, path):
+        return self.lookup(path) is not None
+
+    def open(self, path, root="vfs"):
+        entry = self.lookup(path, root)
+        if entry is None:
+            raise FileNotFoundError("%s: no such file in %s" % (path, root))
+        # disc files may be in several extents, plan entries are in one
+        extents = entry["extents"] if root == "disc" else None
+        return ISOFS_FILE(self.disk, entry["lba"], entry["offset"], entry["size"], extents)
+
+class STORE:
+    #
+    # Content-addressed output store: every distinct file is kept once, as
+    # objects/<sha1[:2]>/<sha1[2:]>, and the output trees of all images are
+    # made of hardlinks or reflinks to it (or only described by a manifest)
+    #
+    def __init__(self, path, link="hardlink"):
+        self.path = path
+        self.link_mode = link
+        self.lock = threading.Lock()
+
+        # objects added, objects that were already stored, and their sizes
+        self.added = 0
+        self.reused = 0
+        self.added_size = 0
+        self.reused_size = 0
+
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "tmp"), exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest[2:])
+
+    def add(self, disk, pos, size, hashes=()):
+        #
+        # Stores `size` bytes of User Data at the raw position `pos` of
+        # `disk`, unless an object with the same SHA-1 is already stored.
+        # The data is hashed first: entries up to STORE_INLINE_SIZE (a
+        # LOW_MEMORY_WINDOW with disk.low_memory) are read into memory and
+        # written from there if they are new, larger ones are only hashed,
+        # and read again (from the page cache or the mapping, by then) if
+        # they are new. Returns the SHA-1 hex digest.
+        #
+        sha1 = hashlib.sha1()
+        hashes = (sha1,) + tuple(hashes)
+
+        if size <= (LOW_MEMORY_WINDOW if disk.low_memory else STORE_INLINE_SIZE):
+            data = io.BytesIO()
+            disk.copy_at(data, pos, size, hashes=hashes)
+        else:
+            data = None
+            with open(os.devnull, "wb") as out:
+                disk.copy_at(out, pos, size, hashes=hashes)
+
+        digest = sha1.hexdigest()
+        obj_path = self.object_path(digest)
+
+        if os.path.exists(obj_path):
+            with self.lock:
+                self.reused += 1
+                self.reused_size += size
+            return digest
+
+        # unique to the process and thread, so workers never collide
+        tmp_path = os.path.join(self.path, "tmp", "%d-%d.part" % (os.getpid(), threading.get_ident()))
+
+        if data is not None:
+            with open(tmp_path, "wb") as out:
+                out.write(data.getbuffer())
+        else:
+            disk.extract_at(tmp_path, pos, size)
+
+        os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+        # objects are shared by every tree linking to them
+        os.chmod(tmp_path, 0o444)
+
+        #
+        # Another worker may have stored the same data since the check above.
+        # Linking fails if it has, so an object is only ever published, and
+        # counted as added, once. Filesystems without hardlinks fall back to
+        # replacing it.
+        #
+        try:
+            os.link(tmp_path, obj_path)
+            added = 1
+        except FileExistsError:
+            added = 0
+        except OSError:
+            added = 0 if os.path.exists(obj_path) else 1
+            os.replace(tmp_path, obj_path)
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+
+        with self.lock:
+            if added:
+                self.added += 1
+                self.added_size += size
+            else:
+                self.reused += 1
+                self.reused_size += size
+
+        return digest
+
+    def link(self, digest, out_path):
+        #
+        # Puts the object `digest` at `out_path`, as a hardlink or reflink if
+        # possible (not across filesystems, for one) or a copy otherwise
+        #
+        obj_path = self.object_path(digest)
+
+        if os.path.lexists(out_path):
+            os.unlink(out_path)
+
+        if self.link_mode == "hardlink":
+            try:
+                os.link(obj_path, out_path)
+                return
+            except OSError:
+                pass
+        elif self.link_mode == "reflink":
+            try:
+                import fcntl
+                with open(obj_path, "rb") as src, open(out_path, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno()) # FICLONE
+                return
+            except (ImportError, OSError):
+                pass
+
+        shutil.copyfile(obj_path, out_path)
+
+class CRC32:
+    # hashlib-style wrapper around zlib.crc32
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+class FILE_HASHES:
+    #
+    # CRC-32, MD5 and SHA-1 of a file, fed the buffers of the copy loop as
+    # they go by, so a manifest of the output costs no second read
+    #
+    def __init__(self):
+        self.crc = CRC32()
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+
+    def update(self, data):
+        self.crc.update(data)
+        self.md5.update(data)
+        self.sha1.update(data)
+
+    def digests(self):
+        return {"crc32": "%08x" % self.crc.value, "md5": self.md5.hexdigest(), "sha1": self.sha1.hexdigest()}
+
+class JOURNAL:
+    #
+    # Append-only record of the output files that were written completely,
+    # so that a repeated or interrupted run can skip them. Every line is a
+    # JSON object; a torn last line from a crash is simply ignored.
+    #
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done[record["path"]] = record
+
+        self.f = open(path, "a")
+
+    def close(self):
+        self.f.close()
+
+    def is_done(self, out_path, entry):
+        record = self.done.get(out_path)
+        if record is None:
+            return 0
+
+        if record["lba"] != entry["lba"] or record["offset"] != entry["offset"] \
+        or record["size"] != entry["size"]:
+            return 0
+
+        try:
+            st = os.stat(out_path)
+        except OSError:
+            return 0
+
+        if st.st_size != record["written"]:
+            return 0
+
+        if st.st_mtime_ns == record["mtime"]:
+            return 1
+
+        #
+        # The file was touched (or copied back) since it was extracted, so
+        # fall back to comparing its checksum
+        #
+        crc = CRC32()
+        with open(out_path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc.update(chunk)
+
+        if crc.value != record["crc"]:
+            return 0
+
+        self.record(out_path, entry, crc.value)
+
+        return 1
+
+    def record(self, out_path, entry, crc):
+        st = os.stat(out_path)
+        record = {
+            "path"    : out_path,
+            "lba"     : entry["lba"],
+            "offset"  : entry["offset"],
+            "size"    : entry["size"],
+            "written" : st.st_size,
+            "mtime"   : st.st_mtime_ns,
+            "crc"     : crc,
+        }
+        with self.lock:
+            self.done[out_path] = record
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+
+class METRICS:
+    #
+    # Opt-in instrumentation of a run: wall and CPU time of every phase, I/O
+    # counters and the time taken by every file. Enabled by assigning an
+    # instance to the module-level `metrics`; costs nothing otherwise.
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = time.time()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.phases = []
+        self.files = []
+        self.counters = {
+            "reads"         : 0,
+            "bytes_read"    : 0,
+            "writes"        : 0,
+            "bytes_written" : 0,
+            "seeks"         : 0,
+        }
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append({
+                    "name"  : name,
+                    "start" : start,
+                    "wall"  : self.now() - start,
+                    "cpu"   : time.process_time() - cpu,
+                    "tid"   : threading.get_ident(),
+                })
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def read(self, size):
+        with self.lock:
+            self.counters["reads"] += 1
+            self.counters["bytes_read"] += size
+
+    def write(self, size):
+        with self.lock:
+            self.counters["writes"] += 1
+            self.counters["bytes_written"] += size
+
+    def file(self, path, size, start, cpu):
+        # `start` from now(), `cpu` from time.thread_time()
+        wall = self.now() - start
+        with self.lock:
+            self.files.append({
+                "path"  : path,
+                "size"  : size,
+                "start" : start,
+                "wall"  : wall,
+                "cpu"   : time.thread_time() - cpu,
+                "mb_s"  : size / wall / 1e6 if wall > 0 else None,
+                "tid"   : threading.get_ident(),
+            })
+
+    def report(self, disk=None):
+        counters = dict(self.counters)
+        if disk is not None and disk.cache is not None:
+            counters["cache_hits"] = disk.cache.hits
+            counters["cache_misses"] = disk.cache.misses
+
+        return {
+            "epoch"    : self.epoch,
+            "wall"     : self.now(),
+            "cpu"      : time.process_time() - self.cpu_start,
+            "phases"   : self.phases,
+            "counters" : counters,
+            "files"    : self.files,
+        }
+
+def phase(name):
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.phase(name)
+
+def trace_events(report, pid=1, name=None, epoch=None):
+    #
+    # Chrome trace events ("X" complete events, times in microseconds) of a
+    # METRICS report; one thread row per extraction thread
+    #
+    shift = 0.0
+    if epoch is not None:
+        shift = report["epoch"] - epoch
+
+    tids = {}
+    events = []
+
+    if name is not None:
+        events.append({"name":"process_name", "ph":"M", "pid":pid, "tid":0, "args":{"name":name}})
+
+    for kind, items in (("phase", report["phases"]), ("file", report["files"])):
+        for item in items:
+            tid = tids.setdefault(item["tid"], len(tids))
+            event = {
+                "name" : item.get("name", item.get("path")),
+                "cat"  : kind,
+                "ph"   : "X",
+                "pid"  : pid,
+                "tid"  : tid,
+                "ts"   : (item["start"] + shift) * 1e6,
+                "dur"  : item["wall"] * 1e6,
+                "args" : {"cpu_ms": item["cpu"] * 1000},
+            }
+            if kind == "file":
+                event["args"]["size"] = item["size"]
+                event["args"]["mb_s"] = item["mb_s"]
+            events.append(event)
+
+    events.append({"name":"counters", "ph":"C", "pid":pid, "tid":0, "ts":(report["wall"] + shift) * 1e6, "args":report["counters"]})
+
+    return events
+
+def save_metrics(path, reports, trace=False):
+    #
+    # Writes the reports of all images of a run, as JSON or a Chrome trace
+    # (chrome://tracing, Perfetto); `reports` maps image paths to reports
+    #
+    if trace:
+        epoch = min(report["epoch"] for report in reports.values())
+        events = []
+        for pid, image in enumerate(sorted(reports)):
+            events += trace_events(reports[image], pid + 1, image, epoch)
+        data = {"traceEvents": events, "displayTimeUnit": "ms"}
+    elif len(reports) == 1:
+        image, report = list(reports.items())[0]
+        data = dict(report, image=image)
+    else:
+        data = {"images": [dict(reports[image], image=image) for image in sorted(reports)]}
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
 
 def crc32(data):
     return zlib.crc32(data) & 0xFFFFFFFF
@@ -451,72 +2222,648 @@ def get_u8(buf, off=0):
 def get_u32_le(buf, off=0):
     return struct.unpack("<I", buf[off:off+4])[0]
 
-def get_c_string(buf, off):
-    end = off
+#
+# EDC / ECC of raw sectors (ECMA-130). The EDC is a CRC-32 with the
+# polynomial 0xD8018001, the ECC the P and Q Reed-Solomon parity of Mode 1
+# and Mode 2 Form 1 sectors.
+#
+ecc_f_lut = [0] * 256
+ecc_b_lut = [0] * 256
+edc_lut = [0] * 256
+for i in range(256):
+    j = ((i << 1) ^ (0x11D if i & 0x80 else 0)) & 0xFF
+    ecc_f_lut[i] = j
+    ecc_b_lut[i ^ j] = i
+    edc = i
+    for k in range(8):
+        edc = (edc >> 1) ^ (0xD8018001 if edc & 1 else 0)
+    edc_lut[i] = edc
+
+def edc_compute(buf):
+    edc = 0
+    for b in buf:
+        edc = (edc >> 8) ^ edc_lut[(edc ^ b) & 0xFF]
+    return edc
+
+def ecc_indices(major_count, minor_count, major_mult, minor_inc):
+    #
+    # Offsets of the bytes every parity byte pair is computed over, in order
+    #
+    size = major_count * minor_count
+    indices = []
+    for major in range(major_count):
+        index = (major >> 1) * major_mult + (major & 1)
+        row = []
+        for minor in range(minor_count):
+            row.append(index)
+            index += minor_inc
+            if index >= size:
+                index -= size
+        indices.append(row)
+    return indices
+
+# P parity covers 0x0C-0x81C, Q parity 0x0C-0x8C8 (including P)
+ECC_P = ecc_indices(86, 24, 2, 86)
+ECC_Q = ecc_indices(52, 43, 86, 88)
+
+def ecc_block(src, indices):
+    major_count = len(indices)
+    dest = bytearray(major_count * 2)
+    for major, row in enumerate(indices):
+        ecc_a = 0
+        ecc_b = 0
+        for index in row:
+            temp = src[index]
+            ecc_a = ecc_f_lut[ecc_a ^ temp]
+            ecc_b ^= temp
+        ecc_a = ecc_b_lut[ecc_f_lut[ecc_a] ^ ecc_b]
+        dest[major] = ecc_a
+        dest[major + major_count] = ecc_a ^ ecc_b
+    return dest
+
+def ecc_generate(sector, zero_address):
+    #
+    # P and Q parity of a Mode 1 / Mode 2 Form 1 sector. For Mode 2 the
+    # header is taken as zero.
+    #
+    header = sector[0x0C:0x10]
+    if zero_address:
+        sector[0x0C:0x10] = b"\x00\x00\x00\x00"
+    sector[0x81C:0x8C8] = ecc_block(sector[0x0C:0x81C], ECC_P)
+    sector[0x8C8:0x930] = ecc_block(sector[0x0C:0x8C8], ECC_Q)
+    sector[0x0C:0x10] = header
+
+SYNC = b"\x00\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\x00"
+
+# where the EDC of a sector is computed over, and stored right after
+EDC_MODE1 = (0x000, 0x810)
+EDC_FORM1 = (0x010, 0x818)
+EDC_FORM2 = (0x010, 0x92C)
+
+def verify_sectors_python(data, xa, ecc):
+    #
+    # Indices of the bad sectors among the raw sectors in `data`, and why
+    #
+    bad = []
+    for i in range(len(data) // 2352):
+        sector = data[i*2352:(i+1)*2352]
+        if sector[0x00:0x0C] != SYNC:
+            bad.append((i, "sync"))
+            continue
+        mode = sector[0x0F]
+        if mode == 1:
+            start, end = EDC_MODE1
+        elif mode == 2 and xa:
+            start, end = EDC_FORM2 if sector[0x12] & 0b100000 else EDC_FORM1
+        else:
+            continue
+        stored = get_u32_le(sector, end)
+        if (stored != 0 or end != EDC_FORM2[1]) and edc_compute(sector[start:end]) != stored:
+            bad.append((i, "EDC"))
+        elif ecc and end != EDC_FORM2[1]:
+            parity = bytearray(sector)
+            ecc_generate(parity, mode == 2)
+            if parity[0x81C:0x930] != sector[0x81C:0x930]:
+                bad.append((i, "ECC"))
+    return bad
+
+#
+# With numpy, whole chunks of sectors are verified at once. The EDC being
+# linear (and starting from 0), it is the XOR of what every byte adds on
+# its own, which only depends on the byte and its distance to the end: so
+# edc_table()[d][b] for every distance d turns the EDC of all sectors into
+# a single gather and reduce. The parity is computed for all sectors one
+# step of the Reed-Solomon code at a time.
+#
+edc_tables = {}
+
+def edc_table():
+    table = edc_tables.get("edc")
+    if table is None:
+        lut = numpy.array(edc_lut, numpy.uint32)
+        table = numpy.empty((EDC_FORM2[1] - EDC_FORM2[0], 256), numpy.uint32)
+        table[0] = lut
+        for d in range(1, len(table)):
+            # one more zero byte after the byte
+            table[d] = (table[d-1] >> 8) ^ lut[table[d-1] & 0xFF]
+        edc_tables["edc"] = table
+        edc_tables["f"] = numpy.array(ecc_f_lut, numpy.uint8)
+        edc_tables["b"] = numpy.array(ecc_b_lut, numpy.uint8)
+        edc_tables["p"] = numpy.array(ECC_P, numpy.intp)
+        edc_tables["q"] = numpy.array(ECC_Q, numpy.intp)
+    return table
+
+def edc_numpy(rows):
+    length = rows.shape[1]
+    table = edc_table()[length-1::-1]
+    return numpy.bitwise_xor.reduce(table[numpy.arange(length), rows], axis=1)
+
+def ecc_numpy(src, indices):
+    f_lut = edc_tables["f"]
+    b_lut = edc_tables["b"]
+    terms = src[:, indices]
+    ecc_a = numpy.zeros(terms.shape[:2], numpy.uint8)
+    for minor in range(terms.shape[2]):
+        ecc_a = f_lut[ecc_a ^ terms[:, :, minor]]
+    ecc_b = numpy.bitwise_xor.reduce(terms, axis=2)
+    ecc_a = b_lut[f_lut[ecc_a] ^ ecc_b]
+    return numpy.concatenate((ecc_a, ecc_a ^ ecc_b), axis=1)
+
+def verify_sectors_numpy(data, xa, ecc):
+    edc_table()
+
+    count = len(data) // 2352
+    sectors = numpy.frombuffer(data, numpy.uint8, count * 2352).reshape(count, 2352)
+
+    reasons = {}
+
+    sync_ok = (sectors[:, 0x00:0x0C] == numpy.frombuffer(SYNC, numpy.uint8)).all(axis=1)
+    for i in numpy.nonzero(~sync_ok)[0]:
+        reasons[int(i)] = "sync"
+
+    mode = sectors[:, 0x0F]
+    form2 = sectors[:, 0x12] & 0b100000 != 0
+
+    groups = [(sync_ok & (mode == 1), EDC_MODE1, 0)]
+    if xa:
+        groups.append((sync_ok & (mode == 2) & ~form2, EDC_FORM1, 1))
+        groups.append((sync_ok & (mode == 2) & form2, EDC_FORM2, None))
+
+    for mask, (start, end), zero_address in groups:
+        # chunks of the gather stay within a few MiB
+        for first in range(0, count, 0x400):
+            index = numpy.nonzero(mask[first:first+0x400])[0] + first
+            if not len(index):
+                continue
+            rows = sectors[index]
+            stored = rows[:, end:end+4].copy().view("<u4")[:, 0]
+            bad = edc_numpy(rows[:, start:end]) != stored
+            if zero_address is None:
+                # Form 2 sectors may leave the EDC out
+                bad &= stored != 0
+            for i in index[bad]:
+                reasons[int(i)] = "EDC"
+            if not ecc or zero_address is None:
+                continue
+            good = index[~bad]
+            src = sectors[good, 0x0C:0x930].copy()
+            if zero_address:
+                src[:, 0:4] = 0
+            p = ecc_numpy(src[:, 0x000:0x810], edc_tables["p"])
+            q = ecc_numpy(src[:, 0x000:0x8BC], edc_tables["q"])
+            wrong = (p != src[:, 0x810:0x8BC]).any(axis=1) | (q != src[:, 0x8BC:0x924]).any(axis=1)
+            for i in good[wrong]:
+                reasons[int(i)] = "ECC"
+
+    return sorted(reasons.items())
+
+def verify_sectors(data, xa, ecc):
+    if numpy is not None:
+        return verify_sectors_numpy(data, xa, ecc)
+    return verify_sectors_python(data, xa, ecc)
+
+#
+# PS2 ADPCM ("VAG"): frames of 16 bytes, a byte of predictor/shift, a byte
+# of flags and 28 4-bit samples, each added to a prediction from the two
+# samples before it
+#
+VAG_COEFS = ((0, 0), (60, 0), (115, -52), (98, -55), (122, -60))
+
+# frames per segment of vectorized decoding, and frames decoded before a
+# segment to settle the history
+VAG_SEGMENT = 64
+VAG_WARMUP = 16
+
+# segments worth decoding side by side before making them shorter
+VAG_LANES = 512
+
+def vag_frame_python(data, pos, out, h1, h2):
+    predictor = data[pos] >> 4
+    shift = data[pos] & 0x0F
+    if shift > 12:
+        shift = 9
+    c1, c2 = VAG_COEFS[predictor] if predictor < 5 else (0, 0)
+    for b in data[pos+2:pos+16]:
+        for nibble in (b & 0x0F, b >> 4):
+            if nibble >= 8:
+                nibble -= 16
+            s = ((nibble << 12) >> shift) + ((h1 * c1 + h2 * c2 + 32) >> 6)
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            out.append(s)
+            h2 = h1
+            h1 = s
+    return h1, h2
+
+def vag_decode_python(data, hist=(0, 0)):
+    #
+    # Samples of the ADPCM frames in `data` (one channel), and the history
+    # to decode the frames following them with
+    #
+    out = array.array("h")
+    h1, h2 = hist
+    for pos in range(0, len(data) - 15, 16):
+        h1, h2 = vag_frame_python(data, pos, out, h1, h2)
+    return out, (h1, h2)
+
+def vag_decode_numpy(data, hist=(0, 0)):
+    #
+    # A frame only depends on the frames before it through the last two
+    # samples, and the decoder forgets a wrong history within a few frames.
+    # So the frames are cut into segments (of VAG_SEGMENT), and all segments
+    # are decoded at once, one sample per step for all of them, each from
+    # the VAG_WARMUP frames before it (from silence) to warm up on. Segments
+    # whose warmed up history differs from the real one, at the end of the
+    # segment before, are decoded again from the real one, until none do:
+    # that's exactly the sequential result. Few segments are ever redone;
+    # the last handful go frame by frame.
+    #
+    count = len(data) // 16
+    if not count:
+        return numpy.zeros(0, numpy.int16), hist
+
+    frames = numpy.frombuffer(data, numpy.uint8, count * 16).reshape(count, 16)
+
+    shift = (frames[:, 0] & 0x0F).astype(numpy.int32)
+    shift[shift > 12] = 9
+    predictor = (frames[:, 0] >> 4).astype(numpy.intp)
+    predictor[predictor > 4] = 5
+    coefs = numpy.array(VAG_COEFS + ((0, 0),), numpy.int32)
+    c1 = coefs[predictor, 0]
+    c2 = coefs[predictor, 1]
+
+    nibbles = numpy.empty((count, 28), numpy.int32)
+    nibbles[:, 0::2] = frames[:, 2:] & 0x0F
+    nibbles[:, 1::2] = frames[:, 2:] >> 4
+    x = ((nibbles << 28) >> 28 << 12) >> shift[:, None]
+
+    out = numpy.empty((count, 28), numpy.int32)
+
+    # short data gets shorter segments, to still have enough of them
+    segment = max(VAG_WARMUP // 2, min(VAG_SEGMENT, count // VAG_LANES))
+
+    segments = -(-count // segment)
+    seg_first = numpy.arange(segments) * segment
+    seg_end = numpy.minimum(seg_first + segment, count)
+
+    # history every segment is decoded from, after `warmup` frames
+    start_h1 = numpy.zeros(segments, numpy.int32)
+    start_h2 = numpy.zeros(segments, numpy.int32)
+    start_h1[0], start_h2[0] = hist
+    warmup = numpy.minimum(seg_first, VAG_WARMUP)
+
+    # history every segment was actually decoded from
+    used_h1 = numpy.zeros(segments, numpy.int32)
+    used_h2 = numpy.zeros(segments, numpy.int32)
+
+    active = numpy.arange(segments)
+
+    while len(active) > 8:
+        first = seg_first[active] - warmup[active]
+        own_first = seg_first[active]
+        own_end = seg_end[active]
+        a1 = start_h1[active]
+        a2 = start_h2[active]
+        res = numpy.empty((len(active), 28), numpy.int32)
+
+        for j in range(int(warmup[active].max()) + segment):
+            index = first + j
+            starting = index == own_first
+            used_h1[active[starting]] = a1[starting]
+            used_h2[active[starting]] = a2[starting]
+            own = (index >= own_first) & (index < own_end)
+            index = numpy.minimum(index, count - 1)
+            xj = x[index]
+            k1 = c1[index]
+            k2 = c2[index]
+            for n in range(28):
+                s = xj[:, n] + ((a1 * k1 + a2 * k2 + 32) >> 6)
+                numpy.minimum(s, 32767, out=s)
+                numpy.maximum(s, -32768, out=s)
+                res[:, n] = s
+                a2 = a1
+                a1 = s
+            out[index[own]] = res[own]
+
+        following = active + 1
+        following = following[following < segments]
+        real_h1 = out[seg_first[following] - 1, 27]
+        real_h2 = out[seg_first[following] - 1, 26]
+        wrong = (real_h1 != used_h1[following]) | (real_h2 != used_h2[following])
+        start_h1[following] = real_h1
+        start_h2[following] = real_h2
+        warmup[following] = 0
+        active = following[wrong]
+
+    done = 0
+    for k in active.tolist():
+        i = seg_first[k]
+        if i < done:
+            # redone by the segment before it
+            continue
+        # everything before is final by now
+        h1, h2 = (int(out[i-1, 27]), int(out[i-1, 26])) if i else hist
+        while i < count:
+            samples = []
+            h1, h2 = vag_frame_python(data, i * 16, samples, h1, h2)
+            out[i] = samples
+            i += 1
+            # the next segment is right if it was decoded from this history
+            if i % segment == 0 and i < count and used_h1[i // segment] == h1 and used_h2[i // segment] == h2:
+                break
+        done = i
+
+    return out.reshape(-1).astype(numpy.int16), (int(out[-1, 27]), int(out[-1, 26]))
+
+def vag_decode(data, hist=(0, 0)):
+    if numpy is not None:
+        return vag_decode_numpy(data, hist)
+    return vag_decode_python(data, hist)
+
+def vag_length(data):
+    #
+    # Size of the sample starting at `data`: up to the first frame with the
+    # end flag, or the end of the data
+    #
+    for pos in range(0, len(data) - 15, 16):
+        if data[pos+1] & 0x01:
+            return pos + 16
+    return len(data) - len(data) % 16
+
+def write_wav(path, rate, channels):
+    wav = wave.open(path, "wb")
+    wav.setnchannels(channels)
+    wav.setsampwidth(2)
+    wav.setframerate(rate)
+    return wav
+
+def pcm_bytes(channels):
+    #
+    # Interleaves the decoded samples of every channel into 16-bit little
+    # endian PCM
+    #
+    length = min(len(samples) for samples in channels)
+    if numpy is not None:
+        return numpy.stack([samples[:length] for samples in channels], axis=1).astype("<i2").tobytes()
+    out = array.array("h", bytes(2 * length * len(channels)))
+    for c, samples in enumerate(channels):
+        out[c::len(channels)] = samples[:length]
+    if sys.byteorder == "big":
+        out.byteswap()
+    return out.tobytes()
+
+def read_file(disk, path):
+    record = disk.toc[path]
+    if len(record["extents"]) == 1:
+        return disk.read_user_at(disk.user_pos(record["lba"]), record["size"])
+    buf = bytearray()
+    for lba, size in record["extents"]:
+        buf += disk.read_user_at(disk.user_pos(lba), size)
+    return buf
+
+def read_file_crc32(disk, path):
+    #
+    # Reads a whole file, updating its CRC one window at a time as the data
+    # comes in, so the file doesn't have to be traversed a second time
+    #
+    record = disk.toc[path]
+
+    buf = bytearray(record["size"])
+    view = memoryview(buf)
 
-    while buf[end] != 0:
-        end += 1
+    crc = 0
+    done = 0
 
-    return buf[off:end].decode("ASCII")
+    for lba, size in record["extents"]:
+        pos = disk.user_pos(lba)
+        end = done + size
+        while done < end:
+            got, pos = disk.readinto_user_at(pos, view[done:min(done+CHUNK_SIZE, end)])
+            if got <= 0:
+                break
+            crc = zlib.crc32(view[done:done+got], crc)
+            done += got
+        if done < end:
+            break
 
-def vfs_ex(disk, meta, exebuf):
+    view.release()
 
-    e_phoff  = get_u32_le(exebuf, 0x1C)
-    p_offset = get_u32_le(exebuf, e_phoff+0x04)
-    p_vaddr  = get_u32_le(exebuf, e_phoff+0x08)
+    if done < len(buf):
+        del buf[done:]
 
-    toc_offset = meta["toc_offset"]
-    toc_count = meta["toc_count"]
+    return buf, crc & 0xFFFFFFFF
+
+def file_crc32(disk, path):
+    #
+    # CRC of a whole file, read through a single LOW_MEMORY_WINDOW buffer
+    #
+    record = disk.toc[path]
+
+    view = memoryview(bytearray(LOW_MEMORY_WINDOW))
+
+    crc = 0
+
+    for lba, size in record["extents"]:
+        pos = disk.user_pos(lba)
+        while size > 0:
+            got, pos = disk.readinto_user_at(pos, view[:min(size, len(view))])
+            if got <= 0:
+                break
+            crc = zlib.crc32(view[:got], crc)
+            size -= got
+
+    view.release()
+
+    return crc & 0xFFFFFFFF
+
+def cache_path(name):
+    root = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    if not root:
+        root = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "sh2ex", name)
+
+def load_cache(name):
+    try:
+        with open(cache_path(name), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_cache(name, entries, stale=None):
+    #
+    # Merges `entries` into the cache `name`, leaving out the keys for which
+    # stale(key) is true. Batch workers update the same cache at once, so
+    # this happens under a lock file (where there is flock), on a fresh
+    # load, through a temporary file of its own.
+    #
+    path = cache_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "a") as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            except (ImportError, OSError):
+                pass
+
+            cache = load_cache(name)
+            cache.update(entries)
+            if stale is not None:
+                cache = dict((key, value) for key, value in cache.items() if not stale(key))
+
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(cache, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+    except OSError:
+        pass
+
+def image_identity(disk):
+    st = os.fstat(disk.f.fileno())
+    return "%s|%d|%d" % (os.path.abspath(disk.path), st.st_size, st.st_mtime_ns)
+
+def stale_identity(identity):
+    # true if the image an identity was taken of is gone or has changed
+    path, size, mtime = identity.rsplit("|", 2)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return True
+    return (str(st.st_size), str(st.st_mtime_ns)) != (size, mtime)
+
+def detect(disk, use_cache=True):
+    #
+    # Returns the metalist entry matching the image, along with the contents
+    # of its executable and IRX, or (None, None, None) if unsupported. With
+    # disk.low_memory, files are hashed a window at a time and the contents
+    # are FILE_WINDOWS, read as the plan needs them.
+    #
+    identity = image_identity(disk)
+
+    def contents(path):
+        if disk.low_memory:
+            record = disk.toc[path]
+            return FILE_WINDOWS(ISOFS_FILE(disk, record["lba"], 0, record["size"], record["extents"]))
+        return read_file(disk, path)
+
+    if use_cache:
+        cache = load_cache("detect.json")
+        if identity in cache:
+            hit = cache[identity]
+            for meta in metalist:
+                if meta["execrc"] == hit["execrc"] and meta["irxcrc"] == hit["irxcrc"] \
+                and meta["exepath"] in disk.toc and meta["irxpath"] in disk.toc:
+                    return meta, contents(meta["exepath"]), contents(meta["irxpath"])
+
+    # (lba, size) -> (contents, crc), so no file is read or hashed twice
+    files = {}
+
+    def identify(path):
+        key = (disk.toc[path]["lba"], disk.toc[path]["size"])
+        if key not in files:
+            if disk.low_memory:
+                files[key] = contents(path), file_crc32(disk, path)
+            else:
+                files[key] = read_file_crc32(disk, path)
+        return files[key]
+
+    for exepath in detect_index:
+
+        if exepath not in disk.toc:
+            continue
+
+        exebuf, execrc = identify(exepath)
+
+        for meta in detect_index[exepath].get(execrc, []):
+
+            irxpath = meta["irxpath"]
+            if irxpath not in disk.toc:
+                continue
 
-    out_root = "%s - vfs" % os.path.splitext(disk.path)[0]
+            irxbuf, irxcrc = identify(irxpath)
+            if irxcrc == meta["irxcrc"]:
 
-    for i in range(toc_count):
+                if use_cache:
+                    update_cache("detect.json", {identity: {"execrc": execrc, "irxcrc": irxcrc}}, stale_identity)
 
-        meta_address = get_u32_le(exebuf, toc_offset+0x00)
-        meta_offset = p_offset + meta_address - p_vaddr
+                return meta, exebuf, irxbuf
 
-        type = get_u32_le(exebuf, meta_offset+0x00)
+    return None, None, None
 
-        if type == 0x50:
+def vfs_plan(disk, meta, exebuf):
+    #
+    # Resolves the TOC of the executable: pairs of addresses of a node and
+    # of the VFS path. A node of type 0x50 adds its offset to the file's
+    # and links to the next node; the last node holds the address of the
+    # path of the disc file. Nodes and strings are shared by many entries,
+    # so both are resolved once. Only reads what it needs of `exebuf`, which
+    # may be FILE_WINDOWS.
+    #
+    elf = ELF_IMAGE(exebuf)
 
-            vfs_offset    = 0
-            vfs_size      = get_u32_le(exebuf, meta_offset+0x0C)
-            vfs_path_addr = get_u32_le(exebuf, toc_offset+0x04)
-            vfs_path_off  = p_offset + vfs_path_addr - p_vaddr
+    toc_offset = meta["toc_offset"]
+    toc_count = meta["toc_count"]
 
-            while type == 0x50:
+    unpack_link = struct.Struct("<3I").unpack
+    unpack_node = struct.Struct("<4I").unpack
 
-                vfs_offset += get_u32_le(exebuf, meta_offset+0x08)
+    strings = {}
 
-                meta_address = get_u32_le(exebuf, meta_offset+0x04)
-                meta_offset = p_offset + meta_address - p_vaddr
+    def string(address):
+        s = strings.get(address)
+        if s is None:
+            off = elf.offset(address)
+            s = strings[address] = exebuf[off:exebuf.index(b"\x00", off)].decode("ASCII")
+        return s
 
-                type = get_u32_le(exebuf, meta_offset+0x00)
+    # node address -> (offset of the file, address of the disc path)
+    chains = {}
 
-            disc_path_addr = get_u32_le(exebuf, meta_offset+0x04)
-            disc_path_off  = p_offset + disc_path_addr - p_vaddr
-            disc_path      = get_c_string(exebuf, disc_path_off).upper()
+    def chain(address):
+        walked = []
+        while address not in chains:
+            off = elf.offset(address)
+            type, next, offset = unpack_link(exebuf[off:off+12])
+            if type != 0x50:
+                # `next` is the address of the disc path
+                chains[address] = (0, next)
+                break
+            walked.append((address, offset))
+            address = next
+        total, path = chains[address]
+        for node, offset in reversed(walked):
+            total += offset
+            chains[node] = (total, path)
+        return chains[walked[0][0]] if walked else chains[address]
 
-            if disc_path in disk.toc:
+    entries = []
 
-                vfs_path = get_c_string(exebuf, vfs_path_off)
-                vfs_dirpath = os.path.dirname(vfs_path)
+    for meta_address, vfs_path_addr in struct.iter_unpack("<II", exebuf[toc_offset:toc_offset+toc_count*8]):
 
-                out_path = os.path.join(out_root, vfs_path)
-                out_dirpath = os.path.dirname(out_path)
+        meta_offset = elf.offset(meta_address)
+        type, next, offset, vfs_size = unpack_node(exebuf[meta_offset:meta_offset+16])
 
-                if not os.path.isdir(out_dirpath):
-                    os.makedirs(out_dirpath)
+        if type != 0x50:
+            continue
 
-                disk.seek_user(disk.toc[disc_path]["lba"], vfs_offset)
+        vfs_offset, disc_path_addr = chains.get(meta_address) or chain(meta_address)
 
-                print("Extracting: %s --> %s ..." % (disc_path, vfs_path))
+        disc_path = string(disc_path_addr).upper()
 
-                disk.extract(out_path, vfs_size)
+        record = disk.toc.get(disc_path)
 
-        toc_offset += 8
+        if record is not None:
+            entries.append(PLAN_ENTRY("vfs", string(vfs_path_addr), disc_path, record["lba"], vfs_offset, vfs_size))
 
-def sound_ex(disk, meta, irxbuf):
+    return entries
+
+def sound_plan(disk, meta, irxbuf, wanted=None):
 
     datpath        = meta["datpath"]
     seq_start_sect = meta["seq_start_sect"]
@@ -528,14 +2875,14 @@ def sound_ex(disk, meta, irxbuf):
 
     dat_sect = disk.toc[datpath]["lba"]
 
-    out_root = "%s - sound" % os.path.splitext(disk.path)[0]
-
-    # ------------------------------------------------------
+    entries = []
 
-    out_dir = os.path.join(out_root, "TriggerData")
+    def add(kind, path, offset, size):
+        if wanted is not None and not wanted("sound", kind, path):
+            return
+        entries.append(PLAN_ENTRY(kind, path, None, dat_sect, offset, size))
 
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
+    # ------------------------------------------------------
 
     table_offset = seq_tbl_offset
 
@@ -560,37 +2907,28 @@ def sound_ex(disk, meta, irxbuf):
             basename = "TD %02d - Misc SFX %02d" % (i, misc_sfx_cnt)
             misc_sfx_cnt += 1
 
-        hd_name = "%s.HD" % basename
-        bd_name = "%s.BD" % basename
-        td_name = "%s.TD" % basename
+        hd_path = os.path.join("TriggerData", "%s.HD" % basename)
+        bd_path = os.path.join("TriggerData", "%s.BD" % basename)
+        td_path = os.path.join("TriggerData", "%s.TD" % basename)
 
-        hd_path = os.path.join(out_dir, hd_name)
-        bd_path = os.path.join(out_dir, bd_name)
-        td_path = os.path.join(out_dir, td_name)
+        # the bank header is only needed for the HD / BD sizes
+        if wanted is None or wanted("sound", "hd", hd_path) or wanted("sound", "bd", bd_path):
 
-        disk.seek_user(dat_sect, dat_offset)
-        header = disk.read_user(0x24)
-        hd_size = get_u32_le(header, 0x1C)
-        bd_size = get_u32_le(header, 0x20)
+            header = disk.read_user_at(disk.user_pos(dat_sect, dat_offset), 0x24)
+            hd_size = get_u32_le(header, 0x1C)
+            bd_size = get_u32_le(header, 0x20)
 
-        # ----------------------------------
+            # ----------------------------------
 
-        disk.seek_user(dat_sect, dat_offset)
+            add("hd", hd_path, dat_offset, hd_size)
 
-        print("Extracting: %s ..." % hd_name)
-        disk.extract(hd_path, hd_size)
-
-        print("Extracting: %s ..." % bd_name)
-        disk.extract(bd_path, bd_size)
+            add("bd", bd_path, dat_offset + hd_size, bd_size)
 
         dat_offset += ((bank_size - 1) & ~2047) + 2048
 
         # ----------------------------------
 
-        disk.seek_user(dat_sect, dat_offset)
-
-        print("Extracting: %s ..." % td_name)
-        disk.extract(td_path, td_size)
+        add("td", td_path, dat_offset, td_size)
 
         dat_offset += ((td_size - 1) & ~2047) + 2048
 
@@ -598,11 +2936,6 @@ def sound_ex(disk, meta, irxbuf):
 
     # ------------------------------------------------------
 
-    out_dir = os.path.join(out_root, "Streams")
-
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
-
     table_offset = stm_tbl_offset
 
     dat_offset = stm_start_sect * 2048
@@ -612,55 +2945,1265 @@ def sound_ex(disk, meta, irxbuf):
         stm_size  = get_u32_le(irxbuf, table_offset+0x04)
         #stm_vol  = get_u32_le(irxbuf, table_offset+0x08)
 
-        stm_name = "Stream %03d.svag" % i
-        stm_path = os.path.join(out_dir, stm_name)
-
-        disk.seek_user(dat_sect, dat_offset)
+        stm_path = os.path.join("Streams", "Stream %03d.svag" % i)
 
-        print("Extracting: %s ..." % stm_name)
-        disk.extract(stm_path, stm_size)
+        add("stream", stm_path, dat_offset, stm_size)
 
         dat_offset += ((stm_size - 1) & ~2047) + 2048
 
         table_offset += 12
 
+    return entries
+
+def extract_entries(disk, out_root, entries, jobs=1, journal=None, verbose=1, store=None, sums=None):
+    #
+    # Extracts `entries` below `out_root`. With a `store`, the files go into
+    # the store and `out_root` gets links to them. Returns the SHA-1 digest
+    # of every entry (None without a store). With `sums`, the FILE_HASHES of
+    # every entry are put in it by path.
+    #
+    manifest_only = store is not None and store.link_mode == "manifest"
+
+    if not manifest_only:
+        for out_dirpath in sorted(set(os.path.dirname(os.path.join(out_root, entry["path"])) for entry in entries)):
+            if not os.path.isdir(out_dirpath):
+                os.makedirs(out_dirpath)
+
+    def extract_entry(entry):
+        out_path = os.path.join(out_root, entry["path"])
+
+        if journal is not None and journal.is_done(out_path, entry):
+            if sums is not None:
+                sums[entry["path"]] = hash_file(out_path)
+            return
+
+        if not verbose:
+            pass
+        elif entry["src"] is not None:
+            print("Extracting: %s --> %s ..." % (entry["src"], entry["path"]))
+        else:
+            print("Extracting: %s ..." % os.path.basename(entry["path"]))
+
+        pos = disk.user_pos(entry["lba"], entry["offset"])
+
+        # the copy feeds the journal's CRC, or all the hashes (CRC included)
+        if sums is not None:
+            hashes = sums[entry["path"]] = FILE_HASHES()
+            crc = hashes.crc
+        else:
+            hashes = crc = CRC32()
+        hashes = (hashes,) if journal is not None or sums is not None else ()
+
+        if store is not None:
+            digest = store.add(disk, pos, entry["size"], hashes=hashes)
+            if not manifest_only:
+                store.link(digest, out_path)
+                if journal is not None:
+                    journal.record(out_path, entry, crc.value)
+            return digest
+
+        if journal is None:
+            if os.path.isfile(out_path) and os.stat(out_path).st_nlink > 1:
+                # don't write through a link into a store
+                os.unlink(out_path)
+            disk.extract_at(out_path, pos, entry["size"], hashes=hashes)
+        else:
+            #
+            # Write to a temporary file and rename it into place once it is
+            # complete, so an interrupted run never leaves a truncated file
+            # under the final name
+            #
+            disk.extract_at(out_path + ".part", pos, entry["size"], hashes=hashes)
+            os.replace(out_path + ".part", out_path)
+            journal.record(out_path, entry, crc.value)
+
+    def timed_entry(entry):
+        start = metrics.now()
+        cpu = time.thread_time()
+        digest = extract_entry(entry)
+        metrics.file(entry["path"], entry["size"], start, cpu)
+        return digest
+
+    run = extract_entry if metrics is None else timed_entry
+
+    if jobs > 1:
+        #
+        # Every entry computes its own position in the image and reads it
+        # with pread, so the workers never share a file position
+        #
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            return list(pool.map(run, entries))
+    else:
+        return [run(entry) for entry in entries]
+
+def schedule(plan):
+    #
+    # Every entry of the plan as (root, index), in order of position in the
+    # image. Files don't overlap on disc, so that's the order of their
+    # starting sectors, then of the offsets into them.
+    #
+    order = [(entry["lba"], entry["offset"], root, i) for root in plan for i, entry in enumerate(plan[root])]
+    order.sort()
+    return [(root, i) for lba, offset, root, i in order]
+
+def extract_plan(disk, plan, jobs=1, journal=None, verbose=1, store=None, sequential=0, sums=None):
+    #
+    # Extracts every root of the plan. Sequential extraction goes over the
+    # image once, front to back (see schedule), rather than in the order of
+    # the executable's TOC, which jumps between archives and SOUND.DAT.
+    # Returns the digests of every root (see extract_entries). With `sums`,
+    # fills in the FILE_HASHES of every root.
+    #
+    if sums is not None:
+        for root in plan:
+            sums.setdefault(root, {})
+
+    if not sequential:
+        digests = {}
+        for root in plan:
+            with phase("extract %s" % root):
+                digests[root] = extract_entries(disk, out_root(disk, root), plan[root], jobs, journal, verbose, store, None if sums is None else sums[root])
+        return digests
+
+    digests = dict((root, [None] * len(plan[root])) for root in plan)
+
+    with phase("extract"):
+        disk.stream()
+        for root, i in schedule(plan):
+            digests[root][i] = extract_entries(disk, out_root(disk, root), plan[root][i:i+1], 1, journal, verbose, store, None if sums is None else sums[root])[0]
+
+    return digests
+
+def decode_tasks(plan):
+    #
+    # What decode_plan() decodes: every stream, and the samples of every
+    # bank whose HD and BD are both planned
+    #
+    tasks = []
+    banks = {}
+
+    for entry in plan.get("sound", []):
+        if entry["kind"] == "stream":
+            tasks.append({"kind":"stream", "path":os.path.splitext(entry["path"])[0] + ".wav", "stream":entry})
+        elif entry["kind"] in ("hd", "bd"):
+            banks.setdefault(os.path.splitext(entry["path"])[0], {})[entry["kind"]] = entry
+
+    for path in banks:
+        if len(banks[path]) == 2:
+            tasks.append({"kind":"bank", "path":path, "hd":banks[path]["hd"], "bd":banks[path]["bd"]})
+
+    return tasks
+
+def decode_stream(disk, entry, out_path):
+    #
+    # Decodes a Svag stream to a WAV file, a chunk of interleave blocks at a
+    # time, straight from the image
+    #
+    header = disk.read_user_at(disk.user_pos(entry["lba"], entry["offset"]), 0x800)
+    if header[:4] != b"Svag":
+        return 0
+
+    size = min(get_u32_le(header, 0x04), entry["size"] - 0x800)
+    rate = get_u32_le(header, 0x08)
+    channels = max(1, header[0x0C] | header[0x0D] << 8)
+    interleave = get_u32_le(header, 0x10) or 0x800
+
+    block = interleave * channels
+    chunk = max(1, disk.chunk_size // block) * block
+
+    f = ISOFS_FILE(disk, entry["lba"], entry["offset"] + 0x800, size)
+    hists = [(0, 0)] * channels
+
+    wav = write_wav(out_path, rate, channels)
+    try:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            decoded = []
+            for c in range(channels):
+                chan = b"".join(data[k+c*interleave:k+(c+1)*interleave] for k in range(0, len(data), block))
+                samples, hists[c] = vag_decode(chan, hists[c])
+                decoded.append(samples)
+            wav.writeframes(pcm_bytes(decoded))
+    finally:
+        wav.close()
+
+    return 1
+
+def decode_bank(disk, hd_entry, bd_entry, out_dir):
+    #
+    # Decodes every sample of a bank, as listed by the Vagi chunk of its HD,
+    # to "Sample NN.wav" files in `out_dir`, a chunk of frames at a time
+    #
+    if disk.low_memory:
+        hd = FILE_WINDOWS(ISOFS_FILE(disk, hd_entry["lba"], hd_entry["offset"], hd_entry["size"]))
+    else:
+        hd = disk.read_user_at(disk.user_pos(hd_entry["lba"], hd_entry["offset"]), hd_entry["size"])
+
+    vagi = get_u32_le(hd, 0x30) if len(hd) >= 0x34 else 0
+    if hd[vagi:vagi+8] != b"IECSigaV":
+        return 0
+
+    count = get_u32_le(hd, vagi + 0x0C) + 1
+
+    samples = []
+    for k in range(count):
+        info = vagi + get_u32_le(hd, vagi + 0x10 + 4 * k)
+        samples.append((get_u32_le(hd, info), hd[info+4] | hd[info+5] << 8))
+
+    # a sample ends at its end flag, or else where the next one starts
+    ends = sorted(set([offset for offset, rate in samples] + [bd_entry["size"]]))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    chunk = max(16, disk.chunk_size - disk.chunk_size % 16)
+
+    for k, (offset, rate) in enumerate(samples):
+        end = ends[bisect.bisect_right(ends, offset)] if offset < bd_entry["size"] else offset
+        f = ISOFS_FILE(disk, bd_entry["lba"], bd_entry["offset"] + offset, end - offset)
+        hist = (0, 0)
+        data = b""
+        wav = write_wav(os.path.join(out_dir, "Sample %02d.wav" % k), rate or 44100, 1)
+        try:
+            while True:
+                more = f.read(chunk)
+                data += more
+                length = vag_length(data)
+                decoded, hist = vag_decode(data[:length], hist)
+                wav.writeframes(pcm_bytes([decoded]))
+                # up to the end flag, or the end of the sample
+                if not more or (length and data[length-15] & 0x01):
+                    break
+                data = data[length:]
+        finally:
+            wav.close()
+
+    return count
+
+def decode_task(disk, out_root, task):
+    out_path = os.path.join(out_root, task["path"])
+    if task["kind"] == "stream":
+        return decode_stream(disk, task["stream"], out_path)
+    return decode_bank(disk, task["hd"], task["bd"], out_path)
+
+# images opened by the decoding worker processes, by path
+worker_disks = {}
+
+def decode_init(path, options, xa_index):
+    #
+    # Opens the image in a decoding worker process with the options of the
+    # parent, and the XA indexes it has (from the sidecar, or built so far)
+    #
+    disk = worker_disks[path] = ISOFS_IMAGE(path, **options)
+    for start, state in xa_index.items():
+        disk.xa_index[start] = XA_FORM_INDEX(disk, start, state)
+
+def decode_worker(path, out_root, task):
+    return decode_task(worker_disks[path], out_root, task)
+
+def decode_plan(disk, plan, jobs=1, verbose=1):
+    #
+    # Decodes the streams and bank samples of the plan to 16-bit PCM WAV
+    # files below the sound output, reading the ADPCM data straight from
+    # the image. Decoding is CPU bound, so with `jobs` > 1 the files are
+    # spread over as many processes, which open the image themselves. The
+    # checkpoints of a gzip image can't be handed to them, so each of them
+    # inflates the image again as far as its files go. Returns the number of
+    # WAV files.
+    #
+    root = out_root(disk, "sound")
+    tasks = decode_tasks(plan)
+
+    for out_dirpath in sorted(set(os.path.dirname(os.path.join(root, task["path"])) for task in tasks)):
+        if not os.path.isdir(out_dirpath):
+            os.makedirs(out_dirpath)
+
+    if verbose:
+        for task in tasks:
+            print("Decoding: %s ..." % task["path"])
+
+    with phase("decode"):
+        if jobs > 1 and len(tasks) > 1 and disk.seekable and disk.path != "-":
+            with disk.xa_lock:
+                xa_index = dict((start, index.state()) for start, index in disk.xa_index.items())
+            with concurrent.futures.ProcessPoolExecutor(jobs, initializer=decode_init, initargs=(disk.path, disk.options, xa_index)) as pool:
+                return sum(pool.map(decode_worker, [disk.path] * len(tasks), [root] * len(tasks), tasks))
+        return sum(decode_task(disk, root, task) for task in tasks)
+
+def out_root(disk, root):
+    return "%s - %s" % (disk.base, root)
+
+def plan_path(disk):
+    return "%s - plan.db" % disk.base
+
+def journal_path(disk):
+    return "%s - journal.jsonl" % disk.base
+
+def manifest_path(disk):
+    return "%s - manifest.json" % disk.base
+
+def save_manifest(disk, meta, plan, digests, store):
+    #
+    # Describes the output of an image in terms of store objects
+    #
+    files = []
+
+    for root in plan:
+        for entry, digest in zip(plan[root], digests[root]):
+            files.append({
+                "path"   : "%s/%s" % (root, entry["path"].replace(os.sep, "/")),
+                "size"   : entry["size"],
+                "sha1"   : digest,
+            })
+
+    manifest = {
+        "image"   : os.path.basename(disk.path),
+        "version" : meta["name"],
+        "store"   : os.path.abspath(store.path),
+        "files"   : files,
+    }
+
+    with open(manifest_path(disk) + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    os.replace(manifest_path(disk) + ".tmp", manifest_path(disk))
+
+def hash_file(path):
+    hashes = FILE_HASHES()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hashes.update(chunk)
+    return hashes
+
+def hashes_path(disk, format):
+    return "%s - hashes.%s" % (disk.base, format)
+
+def save_hashes(disk, meta, plan, sums, format="dat"):
+    #
+    # Writes the path, size, CRC-32, MD5 and SHA-1 of every file extracted,
+    # as a Logiqx XML DAT (as used by No-Intro and Redump, one game named
+    # after the version) or as JSON
+    #
+    files = []
+
+    for root in plan:
+        for entry in plan[root]:
+            hashes = sums.get(root, {}).get(entry["path"])
+            if hashes is None:
+                continue
+            file = {"path": "%s/%s" % (root, entry["path"].replace(os.sep, "/")), "size": entry["size"]}
+            file.update(hashes.digests())
+            files.append(file)
+
+    path = hashes_path(disk, format)
+
+    with open(path + ".tmp", "w", encoding="UTF-8") as f:
+        if format == "json":
+            json.dump({
+                "image"   : os.path.basename(disk.path),
+                "version" : meta["name"],
+                "files"   : files,
+            }, f, indent=1)
+        else:
+            name = xml.sax.saxutils.escape(meta["name"])
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">\n')
+            f.write('<datafile>\n')
+            f.write('\t<header>\n\t\t<name>%s</name>\n\t\t<description>%s</description>\n\t</header>\n' % (name, name))
+            f.write('\t<game name=%s>\n\t\t<description>%s</description>\n' % (xml.sax.saxutils.quoteattr(meta["name"]), name))
+            for file in files:
+                f.write('\t\t<rom name=%s size="%d" crc="%s" md5="%s" sha1="%s"/>\n' % (xml.sax.saxutils.quoteattr(file["path"]), file["size"], file["crc32"], file["md5"], file["sha1"]))
+            f.write('\t</game>\n</datafile>\n')
+
+    os.replace(path + ".tmp", path)
+
+def save_plan(disk, meta, plan):
+    #
+    # Writes the resolved plan to a SQLite sidecar next to the image, so
+    # later runs (and other tools) don't have to parse the executable and
+    # IRX tables again
+    #
+    path = plan_path(disk)
+    try:
+        if os.path.isfile(path + ".tmp"):
+            os.remove(path + ".tmp")
+        db = sqlite3.connect(path + ".tmp")
+        with db:
+            db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("CREATE TABLE entries (root TEXT, kind TEXT, path TEXT, src TEXT, lba INTEGER, offset INTEGER, size INTEGER)")
+            db.execute("CREATE TABLE xa_index (start INTEGER PRIMARY KEY, state TEXT)")
+            db.executemany("INSERT INTO info VALUES (?, ?)", [
+                ("format",   "2"),
+                ("identity", image_identity(disk)),
+                ("execrc",   "%08X" % meta["execrc"]),
+                ("irxcrc",   "%08X" % meta["irxcrc"]),
+            ])
+            for root in plan:
+                db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                    (root, e["kind"], e["path"], e["src"], e["lba"], e["offset"], e["size"]) for e in plan[root]
+                ])
+            with disk.xa_lock:
+                db.executemany("INSERT INTO xa_index VALUES (?, ?)", [
+                    (start, json.dumps(index.state())) for start, index in disk.xa_index.items()
+                ])
+        db.close()
+        os.replace(path + ".tmp", path)
+    except (OSError, sqlite3.Error):
+        pass
+
+def load_plan(disk):
+    #
+    # Returns the metalist entry and plan stored in the sidecar, or
+    # (None, None) if there is none or it was made for a different image
+    #
+    path = plan_path(disk)
+    if not os.path.isfile(path):
+        return None, None
+
+    try:
+        db = sqlite3.connect(path)
+        try:
+            info = dict(db.execute("SELECT key, value FROM info"))
+            if info.get("format") != "2" or info.get("identity") != image_identity(disk):
+                return None, None
+
+            plan = {"vfs": [], "sound": []}
+            for root, kind, path, src, lba, offset, size in db.execute("SELECT * FROM entries ORDER BY rowid"):
+                plan.setdefault(root, []).append(PLAN_ENTRY(kind, path, src, lba, offset, size))
+
+            with disk.xa_lock:
+                for start, state in db.execute("SELECT start, state FROM xa_index"):
+                    disk.xa_index[start] = XA_FORM_INDEX(disk, start, json.loads(state))
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None, None
+
+    for meta in metalist:
+        if "%08X" % meta["execrc"] == info["execrc"] and "%08X" % meta["irxcrc"] == info["irxcrc"]:
+            return meta, plan
+
+    return None, None
+
+# categories selectable with --category
+CATEGORIES = ("vfs", "core", "misc", "bgm", "streams")
+
+def entry_category(root, kind, path):
+    if root == "vfs":
+        return "vfs"
+    if kind == "stream":
+        return "streams"
+    name = os.path.basename(path)
+    if " - BGM " in name:
+        return "bgm"
+    if " - Core SFX " in name:
+        return "core"
+    return "misc"
+
+def plan_filter(include=(), exclude=(), categories=()):
+    #
+    # Returns a predicate wanted(root, kind, path) selecting the entries
+    # in one of `categories` that match any glob of `include` and none of
+    # `exclude`, or None if there's nothing to filter on. Globs are matched
+    # case-insensitively against both "root/path" and "path".
+    #
+    if not include and not exclude and not categories:
+        return None
+
+    include = [pattern.replace("\\", "/").lower() for pattern in include]
+    exclude = [pattern.replace("\\", "/").lower() for pattern in exclude]
+
+    def matches(patterns, root, path):
+        path = path.replace(os.sep, "/").lower()
+        full = "%s/%s" % (root, path)
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(full, pattern) or fnmatch.fnmatchcase(path, pattern):
+                return 1
+        return 0
+
+    def wanted(root, kind, path):
+        if categories and entry_category(root, kind, path) not in categories:
+            return 0
+        if include and not matches(include, root, path):
+            return 0
+        if exclude and matches(exclude, root, path):
+            return 0
+        return 1
+
+    return wanted
+
+def filter_plan(plan, wanted):
+    return dict((root, [entry for entry in plan[root] if wanted(root, entry["kind"], entry["path"])]) for root in plan)
+
+def make_plan(disk, use_cache=True, wanted=None):
+    #
+    # Returns the metalist entry and extraction plan of the image, loading
+    # it from the sidecar if possible, or (None, None) if unsupported. With
+    # a `wanted` filter (see plan_filter), only the entries it accepts are
+    # planned; such a partial plan isn't saved to the sidecar.
+    #
+    meta, plan = None, None
+
+    # a pipe has nothing to key the caches by
+    use_cache = use_cache and disk.seekable
+
+    if use_cache:
+        with phase("load plan"):
+            meta, plan = load_plan(disk)
+
+    if plan is None:
+
+        with phase("detect"):
+            meta, exebuf, irxbuf = detect(disk, use_cache)
+
+        if meta is None:
+            return None, None
+
+        with phase("vfs plan"):
+            vfs = vfs_plan(disk, meta, exebuf)
+
+        with phase("sound plan"):
+            sound = sound_plan(disk, meta, irxbuf, wanted)
+
+        plan = {
+            "vfs"   : vfs,
+            "sound" : sound,
+        }
+
+        if use_cache and wanted is None:
+            if disk.is_xa:
+                #
+                # Index the Forms of every extent that entries start inside
+                # of, so later runs can seek straight from the sidecar
+                #
+                ends = {}
+                for root in plan:
+                    for entry in plan[root]:
+                        if entry["offset"] > 0:
+                            ends[entry["lba"]] = max(ends.get(entry["lba"], 0), entry["offset"] + entry["size"])
+                with phase("xa index"):
+                    for lba in ends:
+                        disk.user_pos(lba, ends[lba])
+            with phase("save plan"):
+                save_plan(disk, meta, plan)
+
+    if wanted is not None:
+        plan = filter_plan(plan, wanted)
+
+    return meta, plan
+
+def archive_format(path):
+    name = path.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    elif name.endswith(".tar.gz") or name.endswith(".tgz"):
+        return "tar.gz"
+    elif name.endswith(".tar.zst") or name.endswith(".tzst"):
+        return "tar.zst"
+    else:
+        return "tar"
+
+def archive_entries(disk, plan, path, format, sequential=0):
+    #
+    # Streams every planned entry into a single tar or zip archive, read
+    # straight from the image. Sizes are known from the plan, so nothing is
+    # staged in temporary files, and `path` may be "-" to write to stdout.
+    # Sequential archiving adds the entries in order of position instead.
+    #
+    if path == "-":
+        f = sys.stdout.buffer
+        log = sys.stderr
+    else:
+        f = open(path, "wb")
+        log = sys.stdout
+
+    mtime = int(os.fstat(disk.f.fileno()).st_mtime) if disk.seekable else int(time.time())
+
+    if sequential:
+        disk.stream()
+        order = schedule(plan)
+    else:
+        order = [(root, i) for root in plan for i in range(len(plan[root]))]
+
+    names = []
+    for root, i in order:
+        entry = plan[root][i]
+        names.append(("%s/%s" % (root, entry["path"].replace(os.sep, "/")), entry))
+
+    if format == "zip":
+        with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, entry in names:
+                print("Archiving: %s ..." % name, file=log)
+                info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+                info.file_size = entry["size"]
+                if metrics is not None:
+                    start, cpu = metrics.now(), time.thread_time()
+                with zf.open(info, "w") as out:
+                    shutil.copyfileobj(ISOFS_FILE(disk, entry["lba"], entry["offset"], entry["size"]), out, disk.chunk_size)
+                if metrics is not None:
+                    metrics.file(name, entry["size"], start, cpu)
+                    metrics.write(entry["size"])
+    else:
+        stream = f
+        mode = "w|"
+        if format == "tar.gz":
+            mode = "w|gz"
+        elif format == "tar.zst":
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+
+        with tarfile.open(fileobj=stream, mode=mode, bufsize=disk.chunk_size) as tar:
+            for name, entry in names:
+                print("Archiving: %s ..." % name, file=log)
+                info = tarfile.TarInfo(name)
+                info.size = entry["size"]
+                info.mtime = mtime
+                if metrics is not None:
+                    start, cpu = metrics.now(), time.thread_time()
+                tar.addfile(info, ISOFS_FILE(disk, entry["lba"], entry["offset"], entry["size"]))
+                if metrics is not None:
+                    metrics.file(name, entry["size"], start, cpu)
+                    metrics.write(entry["size"])
+
+        if stream is not f:
+            stream.close()
+
+    if f is sys.stdout.buffer:
+        f.flush()
+    else:
+        f.close()
+
+# sectors per chunk of verification
+VERIFY_CHUNK = 0x1000
+
+def verify_range(path, first, count, xa, ecc):
+    with open(path, "rb") as f:
+        data = pread(f, count * 2352, first * 2352, threading.Lock())
+    return [(first + i, reason) for i, reason in verify_sectors(data, xa, ecc)]
+
+def verify_image(disk, ecc=0, jobs=1):
+    #
+    # Checks the EDC (and with `ecc`, the P/Q parity) of every sector of a
+    # raw image, `jobs` chunks at a time. Returns the (LBA, reason) of every
+    # bad sector, in order.
+    #
+    count = disk.size // disk.sector_size
+    firsts = list(range(0, count, VERIFY_CHUNK))
+    counts = [min(VERIFY_CHUNK, count - first) for first in firsts]
+
+    bad = []
+
+    if jobs > 1 and disk.src is None and disk.seekable:
+        # the work is CPU bound, so every chunk goes to a process
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            n = len(firsts)
+            for result in pool.map(verify_range, [disk.path] * n, firsts, counts, [disk.is_xa] * n, [ecc] * n):
+                bad += result
+    else:
+        for first, n in zip(firsts, counts):
+            data = disk.read_raw(first * 2352, n * 2352)
+            bad += [(first + i, reason) for i, reason in verify_sectors(data, disk.is_xa, ecc)]
+
+    if metrics is not None:
+        metrics.count("sectors_verified", count)
+
+    return bad
+
+def sector_files(disk, plan, lbas):
+    #
+    # The files every sector in `lbas` belongs to: the planned entries as
+    # root/path, and the files of the ISO9660 filesystem as disc/path
+    #
+    spans = []
+
+    if plan is not None:
+        for root in plan:
+            for entry in plan[root]:
+                if entry["size"] <= 0:
+                    continue
+                first = disk.user_pos(entry["lba"], entry["offset"]) // disk.sector_size
+                last = disk.user_pos(entry["lba"], entry["offset"] + entry["size"] - 1) // disk.sector_size
+                spans.append((first, last, "%s/%s" % (root, entry["path"].replace(os.sep, "/"))))
+
+    for name, record in disk.toc.items():
+        for lba, size in record["extents"]:
+            if size > 0:
+                spans.append((lba, lba + (size - 1) // 2048, "disc/%s" % name))
+
+    spans.sort()
+
+    files = {}
+    for lba in lbas:
+        files[lba] = [name for first, last, name in spans if first <= lba <= last]
+
+    return files
+
+# extensions picked up when scanning directories for disk images
+IMAGE_EXTS = (".iso", ".bin", ".img", ".cso", ".zso", ".gz")
+
+def find_images(paths):
+    #
+    # Expands directories into the disk images below them, leaving out the
+    # output directories of earlier runs (full of .bin files)
+    #
+    images = []
+
+    for path in paths:
+        if path == "-":
+            images.append(path)
+            continue
+        if not os.path.isdir(path):
+            images.append(os.path.realpath(path))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.endswith((" - vfs", " - sound")))
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTS):
+                    images.append(os.path.realpath(os.path.join(dirpath, filename)))
+
+    return list(dict.fromkeys(images))
+
+def batch_extract(path, jobs=1, resume=0, use_cache=True, store_path=None, link="hardlink", instrument=0, select=((), (), ()), sequential=0, decode=0, io=(IO_DEPTH, IO_BUFFER), low_memory=0, hash_format=None):
+    #
+    # Extracts one image of a batch. Runs in a worker process, so rather
+    # than printing every file it returns a summary of the image.
+    #
+    result = {"path":path, "name":None, "files":0, "size":0, "new":0, "error":None}
+
+    start = time.time()
+
+    # workers are reused across images, so every image starts afresh
+    global metrics
+    metrics = METRICS() if instrument else None
+
+    try:
+        with phase("open"):
+            disk = ISOFS_IMAGE(path, use_mmap=(jobs <= 1 and not sequential), io_depth=io[0], io_buffer=io[1], low_memory=low_memory)
+        try:
+            meta, plan = make_plan(disk, use_cache, plan_filter(*select))
+            if plan is None:
+                result["error"] = "Unsupported version"
+            else:
+                result["name"] = meta["name"]
+                journal = None
+                if resume:
+                    journal = JOURNAL(journal_path(disk))
+                store = None
+                if store_path is not None:
+                    store = STORE(store_path, link)
+                sums = {} if hash_format is not None else None
+                digests = extract_plan(disk, plan, jobs, journal, 0, store, sequential, sums)
+                if sums is not None:
+                    save_hashes(disk, meta, plan, sums, hash_format)
+                if decode:
+                    # already one process per image
+                    decode_plan(disk, plan, 1, 0)
+                for root in plan:
+                    result["files"] += len(plan[root])
+                    result["size"] += sum(entry["size"] for entry in plan[root])
+                if journal is not None:
+                    journal.close()
+                if store is not None:
+                    result["new"] = store.added
+                    if link == "manifest":
+                        save_manifest(disk, meta, plan, digests, store)
+                else:
+                    result["new"] = result["files"]
+            if metrics is not None:
+                result["metrics"] = metrics.report(disk)
+        finally:
+            disk.close()
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+
+    result["time"] = time.time() - start
+
+    return result
+
+def batch_ex(images, workers, jobs=1, resume=0, use_cache=True, store_path=None, link="hardlink", instrument=0, select=((), (), ()), sequential=0, decode=0, io=(IO_DEPTH, IO_BUFFER), low_memory=0, hash_format=None):
+    #
+    # Extracts every image in `images`, `workers` images at a time, each in
+    # its own process (so the images don't contend for one GIL), then prints
+    # a summary. Never prompts. Returns the results of all images.
+    #
+    results = []
+
+    start = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(batch_extract, path, jobs, resume, use_cache, store_path, link, instrument, select, sequential, decode, io, low_memory, hash_format): path for path in images}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker itself died
+                result = {"path":futures[future], "name":None, "files":0, "size":0, "new":0, "error":str(e) or type(e).__name__, "time":0.0}
+            results.append(result)
+            if result["error"] is None:
+                print("[%d/%d] %s: %s, %d files (%d new), %.1f MiB in %.1fs" % (len(results), len(images), result["path"], result["name"], result["files"], result["new"], result["size"] / 0x100000, result["time"]))
+            else:
+                print("[%d/%d] %s: %s" % (len(results), len(images), result["path"], result["error"]))
+            sys.stdout.flush()
+
+    done = [result for result in results if result["error"] is None]
+    failed = [result for result in results if result["error"] is not None]
+
+    print("")
+    print("Extracted %d of %d images: %d files (%d new), %.1f MiB in %.1fs" % (len(done), len(results), sum(result["files"] for result in done), sum(result["new"] for result in done), sum(result["size"] for result in done) / 0x100000, time.time() - start))
+
+    for name in sorted(set(result["name"] for result in done)):
+        print("  %s: %d" % (name, sum(1 for result in done if result["name"] == name)))
+
+    if failed:
+        print("Failed:")
+        for result in sorted(failed, key=lambda result: result["path"]):
+            print("  %s: %s" % (result["path"], result["error"]))
+
+    return results
+
+def write_metrics(args, reports):
+    if args.metrics is not None:
+        save_metrics(args.metrics, reports)
+    if args.trace is not None:
+        save_metrics(args.trace, reports, trace=True)
+
+def vfs_ex(disk, meta, exebuf, jobs=1):
+
+    extract_entries(disk, out_root(disk, "vfs"), vfs_plan(disk, meta, exebuf), jobs)
+
+def sound_ex(disk, meta, irxbuf, jobs=1):
+
+    extract_entries(disk, out_root(disk, "sound"), sound_plan(disk, meta, irxbuf), jobs)
+
+def verify_ex(path, ecc=0, jobs=1, use_cache=True):
+    #
+    # Verifies one image and prints its bad sectors. Returns their number.
+    #
+    start = time.time()
+
+    disk = ISOFS_IMAGE(path, use_mmap=(jobs <= 1))
+
+    try:
+        if not disk.is_raw:
+            print("%s: nothing to verify, the image only holds User Data" % path)
+            return 0
+
+        with phase("verify"):
+            bad = verify_image(disk, ecc, jobs)
+
+        files = {}
+        if bad:
+            meta, plan = make_plan(disk, use_cache)
+            files = sector_files(disk, plan, [lba for lba, reason in bad])
+
+        print("%s: verified the %s of %d sectors in %.1fs, %d bad" % (path, "EDC and ECC" if ecc else "EDC", disk.size // disk.sector_size, time.time() - start, len(bad)))
+        for lba, reason in bad:
+            print("  LBA %d: %s mismatch%s" % (lba, reason, "".join("\n    %s" % name for name in files[lba])))
+
+        return len(bad)
+    finally:
+        disk.close()
+
+def byte_range(header, size):
+    #
+    # (start, end) of the byte range a Range header asks for, None to send
+    # the whole file (no header, several ranges, or one that doesn't parse),
+    # or (size, size) if it asks for nothing that's in the file
+    #
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip(), re.ASCII)
+    if match is None or not any(match.groups()):
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        # the last `last` bytes
+        if int(last) == 0 or size == 0:
+            return size, size
+        return max(size - int(last), 0), size
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return size, size
+
+    return start, min(int(last) + 1, size) if last else size
+
+class SH2_HANDLER(http.server.BaseHTTPRequestHandler):
+    #
+    # Serves the files of an SH2_IMAGE (server.image) straight out of the
+    # image, without extracting anything:
+    #
+    #   GET /              {"name": version, "roots": [...]}
+    #   GET /vfs/          [{"path": ..., "size": ...}, ...] of a root
+    #   GET /vfs/data/...  the file, or the single byte range asked for
+    #
+    # Roots are those of SH2_IMAGE: vfs, sound and disc. Every request runs
+    # in a thread of its own; they all read through the one ISOFS_IMAGE and
+    # its mapping or sector cache.
+    #
+    server_version = "sh2ex"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(1)
+
+    def do_HEAD(self):
+        self.respond(0)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Range")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_headers(self, status, type, length, extra=()):
+        self.send_response(status)
+        self.send_header("Content-Type", type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "Content-Length, Content-Range, Accept-Ranges")
+        for key, value in extra:
+            self.send_header(key, value)
+        self.end_headers()
+
+    def send_json(self, data, body):
+        buf = json.dumps(data).encode("UTF-8")
+        self.send_headers(200, "application/json", len(buf))
+        if body:
+            self.wfile.write(buf)
+
+    def respond(self, body):
+        image = self.server.image
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        root, sep, name = path.lstrip("/").partition("/")
+
+        if not root:
+            return self.send_json({"name": image.meta["name"], "roots": list(image.plan) + ["disc"]}, body)
+
+        if root not in image.plan and root != "disc":
+            return self.send_error(404)
+
+        if not name:
+            if root == "disc":
+                files = [{"path": name, "size": record["size"]} for name, record in image.disk.toc.items()]
+            else:
+                files = [{"path": entry["path"].replace(os.sep, "/"), "size": entry["size"]} for entry in image.plan[root]]
+            return self.send_json(files, body)
+
+        entry = image.lookup(name, root)
+        if entry is None:
+            return self.send_error(404)
+
+        size = entry["size"]
+        span = byte_range(self.headers.get("Range"), size)
+
+        if span is None:
+            start, end = 0, size
+            self.send_headers(200, mimetypes.guess_type(name)[0] or "application/octet-stream", size, [("Accept-Ranges", "bytes")])
+        elif span[0] >= size:
+            return self.send_headers(416, "text/plain", 0, [("Content-Range", "bytes */%d" % size)])
+        else:
+            start, end = span
+            self.send_headers(206, mimetypes.guess_type(name)[0] or "application/octet-stream", end - start, [
+                ("Accept-Ranges", "bytes"),
+                ("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size)),
+            ])
+
+        if not body or end <= start:
+            return
+
+        disk = image.disk
+        done = 0
+
+        try:
+            # one run per extent the range covers
+            for pos, size in image.open(name, root).runs(start, end - start):
+                if disk.is_raw:
+                    got, pos = disk.copy_user(self.wfile, pos, size)
+                else:
+                    got = disk.copy_raw(self.wfile, pos, size)
+                done += got
+                if got != size:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            done = -1
+
+        # the client went away, or the image ended short of the length sent
+        if done != end - start:
+            self.close_connection = True
+
+def serve_ex(path, address, use_cache=True, low_memory=0):
+    #
+    # Serves the files of one image over HTTP until interrupted, see
+    # SH2_HANDLER. `address` is [HOST:]PORT, HOST defaulting to localhost.
+    #
+    host, sep, port = address.rpartition(":")
+
+    with SH2_IMAGE(path, use_cache, low_memory) as image:
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), SH2_HANDLER)
+        server.daemon_threads = True
+        server.image = image
+
+        host, port = server.server_address[:2]
+        print("Serving %s (%s) at http://%s:%d/ ..." % (path, image.meta["name"], host, port))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    return 0
+
 def main(argc=len(sys.argv), argv=sys.argv):
 
-    if argc != 2:
-        print("Usage: %s <disk>" % argv[0])
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+        description="Extracts internal filesystem and sound data of Silent Hill 2")
+    parser.add_argument("disk", nargs="+",
+        help="path to a disk image, or - to read one from stdin; several "
+             "images or directories of them are extracted as a batch")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+        help="extract N files at a time (default: 1)")
+    parser.add_argument("-w", "--workers", type=int, metavar="N",
+        help="extract N images of a batch at a time, each in its own process "
+             "(default: number of CPUs)")
+    parser.add_argument("-b", "--batch", action="store_true",
+        help="batch mode even for a single image: print a summary instead of "
+             "every file, and never prompt")
+    parser.add_argument("-S", "--sequential", action="store_true",
+        help="extract in a single pass over the image, in order of position "
+             "rather than of the executable's TOC (implied for pipes)")
+    parser.add_argument("-o", "--output", metavar="BASE",
+        help="name outputs BASE - vfs, BASE - sound, etc. (default: the image "
+             "path without its extension; required for pipes)")
+    parser.add_argument("-d", "--decode", action="store_true",
+        help="also decode the streams and the samples of the sound banks to WAV "
+             "files, N at a time with -j N")
+    parser.add_argument("-V", "--verify", action="store_true",
+        help="check the EDC of every sector of raw images instead of extracting, "
+             "and report the files bad sectors belong to")
+    parser.add_argument("--ecc", action="store_true",
+        help="also check the ECC parity of Mode 1 / Form 1 sectors (implies --verify)")
+    parser.add_argument("-l", "--list", action="store_true",
+        help="list the files that would be extracted, then exit")
+    parser.add_argument("-r", "--resume", action="store_true",
+        help="skip files that were completely extracted by a previous run")
+    parser.add_argument("-a", "--archive", metavar="FILE",
+        help="write all files into a single tar or zip archive instead of a "
+             "directory tree (.tar, .tar.gz, .tar.zst or .zip; - for stdout)")
+    parser.add_argument("--archive-format", choices=("tar", "tar.gz", "tar.zst", "zip"),
+        help="archive format (default: from the archive's file extension)")
+    parser.add_argument("-s", "--store", metavar="DIR",
+        help="keep every distinct file once in the content-addressed store DIR, "
+             "and build the output trees out of links to it")
+    parser.add_argument("--link", choices=("hardlink", "reflink", "copy", "manifest"), default="hardlink",
+        help="how output trees refer to the store (default: hardlink); manifest "
+             "writes <image> - manifest.json instead of a tree")
+    parser.add_argument("-i", "--include", action="append", default=[], metavar="GLOB",
+        help="only extract files matching GLOB, e.g. \"data/bg/*\" or "
+             "\"sound/Streams/*\" (repeatable)")
+    parser.add_argument("-x", "--exclude", action="append", default=[], metavar="GLOB",
+        help="don't extract files matching GLOB (repeatable)")
+    parser.add_argument("-c", "--category", action="append", default=[], choices=CATEGORIES,
+        help="only extract files of this category (repeatable)")
+    parser.add_argument("--metrics", metavar="FILE",
+        help="write per-phase wall/CPU times, I/O counters and per-file timings "
+             "of the run to FILE, as JSON")
+    parser.add_argument("--trace", metavar="FILE",
+        help="write the same as a Chrome trace (chrome://tracing, Perfetto)")
+    parser.add_argument("--io-depth", type=int, default=IO_DEPTH, metavar="N",
+        help="buffers in flight between reading the image and writing a file "
+             "(default: %d; 1 reads and writes in turns)" % IO_DEPTH)
+    parser.add_argument("--io-buffer", type=int, default=IO_BUFFER // 1024, metavar="KIB",
+        help="size of those buffers in KiB (default: %d)" % (IO_BUFFER // 1024))
+    parser.add_argument("--low-memory", action="store_true",
+        help="hash the executable and IRX a window at a time and only read the parts "
+             "of them the tables point to, don't map the image, and cut caches and "
+             "buffers to a few windows (see LOW_MEMORY_WINDOW)")
+    parser.add_argument("--hashes", choices=("dat", "json"),
+        help="hash every file while extracting it, and write the path, size, CRC-32, "
+             "MD5 and SHA-1 of all of them to <image> - hashes.dat (Logiqx XML) or .json")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+        help="serve the files of the image over HTTP (with byte ranges) instead "
+             "of extracting them; HOST defaults to 127.0.0.1")
+    parser.add_argument("--no-cache", action="store_true",
+        help="don't use or update the version detection cache and the plan sidecar")
+    args = parser.parse_args(argv[1:argc])
+
+    if args.archive is not None:
+        if args.archive_format is None:
+            args.archive_format = archive_format(args.archive)
+        if args.archive_format == "tar.zst" and zstandard is None:
+            parser.error("zstd compressed archives require the zstandard module")
+
+    if args.decode and args.archive is not None:
+        parser.error("--decode writes WAV files into the output tree, not into archives")
+
+    if args.hashes is not None and args.archive is not None:
+        parser.error("--hashes hashes the files as they are extracted into the output tree, not into archives")
+
+    if args.store is not None:
+        if args.archive is not None:
+            parser.error("--store and --archive are mutually exclusive")
+        if args.link == "manifest" and args.resume:
+            parser.error("--resume needs an output tree, not a manifest")
+
+    select = (args.include, args.exclude, args.category)
+
+    if args.io_depth < 1 or args.io_buffer < 1:
+        parser.error("--io-depth and --io-buffer must be at least 1")
+    io = (args.io_depth, args.io_buffer * 1024)
+
+    images = find_images(args.disk)
+
+    global metrics
+    instrument = args.metrics is not None or args.trace is not None
+
+    if args.verify or args.ecc:
+        bad = 0
+        reports = {}
+        for path in images:
+            # every image is a report of its own, as in batch mode
+            if instrument:
+                metrics = METRICS()
+            try:
+                bad += verify_ex(path, args.ecc, args.jobs, not args.no_cache)
+            except ValueError as e:
+                print(e)
+                bad += 1
+            if instrument:
+                reports[path] = metrics.report()
+        if instrument:
+            write_metrics(args, reports)
+        return 1 if bad else 0
+
+    if args.serve is not None:
+        if len(images) != 1 or images[0] == "-":
+            parser.error("--serve takes a single disk image file")
+        if not args.serve.rpartition(":")[2].isdigit():
+            parser.error("--serve takes [HOST:]PORT")
+        try:
+            return serve_ex(images[0], args.serve, not args.no_cache, args.low_memory)
+        except ValueError as e:
+            print(e)
+            return 1
+
+    if args.sequential and args.jobs > 1:
+        parser.error("--sequential extracts one file at a time, leave out --jobs")
+
+    if args.batch or len(images) != 1 or os.path.isdir(args.disk[0]):
+        if args.list or args.archive is not None or args.output is not None:
+            parser.error("--list, --archive and --output take a single disk image")
+        if "-" in images:
+            parser.error("stdin can't be part of a batch")
+        if not images:
+            print("No disk images found.")
+            return 1
+        workers = args.workers or min(len(images), os.cpu_count() or 1)
+        results = batch_ex(images, workers, args.jobs, args.resume, not args.no_cache, args.store, args.link, instrument, select, args.sequential, args.decode, io, args.low_memory, args.hashes)
+        if instrument:
+            write_metrics(args, dict((result["path"], result["metrics"]) for result in results if "metrics" in result))
+        return 0 if all(result["error"] is None for result in results) else 1
+
+    path_in = images[0]
+
+    if instrument:
+        metrics = METRICS()
+
+    #
+    # Page faults on a mapping are taken with the GIL held, which would
+    # serialize the workers on I/O, so parallel runs read with pread instead
+    #
+    try:
+        with phase("open"):
+            disk = ISOFS_IMAGE(path_in, use_mmap=(args.jobs <= 1 and not args.sequential), io_depth=io[0], io_buffer=io[1], low_memory=args.low_memory)
+    except ValueError as e:
+        print(e)
         return 1
 
-    path_in = os.path.realpath(argv[1])
+    #
+    # A pipe can only be read forward, and stdin can't answer prompts
+    #
+    if not disk.seekable:
+        if args.output is None and not args.list:
+            parser.error("images read from a pipe need --output")
+        if args.decode:
+            parser.error("images read from a pipe can't be decoded, extract them first")
+        if args.jobs > 1:
+            parser.error("images read from a pipe are extracted one file at a time, leave out --jobs")
+        args.sequential = True
 
-    disk = ISOFS_IMAGE(path_in)
+    if args.output is not None:
+        disk.base = args.output
 
-    for meta in metalist:
+    pause = print if path_in == "-" else input
 
-        exepath = meta["exepath"]
-        if exepath in disk.toc:
+    meta, plan = make_plan(disk, not args.no_cache, plan_filter(*select))
 
-            irxpath = meta["irxpath"]
-            if irxpath in disk.toc:
+    if plan is None:
+
+        pause("Unsupported version.")
 
-                disk.seek_user(disk.toc[exepath]["lba"])
-                exebuf = disk.read_user(disk.toc[exepath]["size"])
-                if crc32(exebuf) == meta["execrc"]:
+        return 1
 
-                    disk.seek_user(disk.toc[irxpath]["lba"])
-                    irxbuf = disk.read_user(disk.toc[irxpath]["size"])
-                    if crc32(irxbuf) == meta["irxcrc"]:
+    if args.list:
+        for root in plan:
+            for entry in plan[root]:
+                print("%8d %10d %10d  %s/%s" % (entry["lba"], entry["offset"], entry["size"], root, entry["path"].replace(os.sep, "/")))
+        return 0
 
-                        vfs_ex(disk, meta, exebuf)
+    if args.archive is not None:
 
-                        sound_ex(disk, meta, irxbuf)
+        with phase("archive"):
+            archive_entries(disk, plan, args.archive, args.archive_format, args.sequential)
 
-                        input("All done.")
+        if metrics is not None:
+            write_metrics(args, {path_in: metrics.report(disk)})
 
-                        return 0
+        if args.archive != "-":
+            pause("All done.")
 
-    input("Unsupported version.")
+        return 0
 
-    return 1
+    journal = None
+    if args.resume:
+        journal = JOURNAL(journal_path(disk))
+
+    store = None
+    if args.store is not None:
+        store = STORE(args.store, args.link)
+
+    sums = {} if args.hashes is not None else None
+
+    digests = extract_plan(disk, plan, args.jobs, journal, 1, store, args.sequential, sums)
+
+    if sums is not None:
+        save_hashes(disk, meta, plan, sums, args.hashes)
+
+    if args.decode:
+        decode_plan(disk, plan, args.jobs)
+
+    if journal is not None:
+        journal.close()
+
+    if store is not None:
+        if args.link == "manifest":
+            save_manifest(disk, meta, plan, digests, store)
+        print("Stored %d new files (%.1f MiB), %d were already stored (%.1f MiB)" % (store.added, store.added_size / 0x100000, store.reused, store.reused_size / 0x100000))
+
+    if metrics is not None:
+        write_metrics(args, {path_in: metrics.report(disk)})
+
+    pause("All done.")
+
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())